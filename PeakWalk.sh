@@ -78,20 +78,24 @@ if [[ ! -z "$targetlist" ]]; then
   echo "starting targetted search"
   python3 $PEAK_WALK/python/GCCombo.py -a $adapdir -f $featuredir -t $targetlist -p $processors
   python3 $PEAK_WALK/python/GCSummary.py -f $featuredir
-  if [[ ! -z "$batchfile" ]] && [[ ! -z "$stdlib" ]]; then
-    python3 $PEAK_WALK/python/GCSummary.py -f $featuredir -b $batchfile -s $stdlib -x
-    if [[ ! -z "$correlation" ]]; then
-      python3 $PEAK_WALK/python/GCSummary.py -f $featuredir -b $batchfile -s $stdlib -x -c $correlation -n feature.subject.summary.corr.csv
-    fi
-  fi
 fi
 
 if [[ ! -z "$batchfile" ]] && [[ ! -z "$stdlib" ]]; then
   echo "performing quantification"
   python3 $PEAK_WALK/python/GCQuant.py -i $featuredir"/feature.sample.i.csv" -d $batchfile -s $stdlib -q $featuredir"/feature.sample.quant.csv"
-  python3 $PEAK_WALK/python/GCSummary.py -f $featuredir -b $batchfile -s $stdlib -x --quant
+  # replicate summaries are written in one pass over the feature files
+  variants="subject.qsummary"
+  correlationopt=""
   if [[ ! -z "$correlation" ]]; then
-    python3 $PEAK_WALK/python/GCSummary.py -f $featuredir -b $batchfile -s $stdlib -x --quant -c $correlation -n feature.subject.qsummary.corr.csv
+    variants=$variants",subject.qsummary.corr"
+    correlationopt="-c $correlation"
+  fi
+  if [[ ! -z "$targetlist" ]]; then
+    if [[ ! -z "$correlation" ]]; then
+      variants="subject.summary.corr,"$variants
+    fi
+    variants="subject.summary,"$variants
   fi
+  python3 $PEAK_WALK/python/GCSummary.py -f $featuredir -b $batchfile -s $stdlib $correlationopt -p $processors --variants=$variants
 fi
 
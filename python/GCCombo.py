@@ -1,481 +1,1289 @@
-#!/usr/bin/python3
-
-# os operation libraries
-import sys
-import os
-import getopt
-
-from multiprocessing import Process, Queue, Lock
-
-# data libraries
-import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-import warnings
-warnings.filterwarnings('ignore')
-
-# import dtw
-from fastdtw import fastdtw
-
-# set global variables
-drtMax = 0.02
-
-# setup logging
-log = "log.txt"
-loglock = Lock()
-
-# DTW similarity score
-def DTW(trtdelta, rtdelta):
-  _, path = fastdtw(rtdelta, trtdelta)
-  length = max(len(rtdelta), len(trtdelta))
-  similarity = 1 - len(path) / length
-  return similarity
-
-# Search for targets on a single sample
-# using DWT criteria
-def matchDTW(matches, idSubids, mzRts):
-  # Get Relative distances for targets and matches
-  trtdeltas = abs(idSubids.trt.values[:, None] - idSubids.trt.values).tolist()
-  rtdeltas = abs(mzRts.rt.values[:, None] - mzRts.rt.values).tolist()
-
-  # Get DWT scores for all relevant matches
-  for idSubid in idSubids.idSubid:
-    submatches = matches[(matches.idSubid == idSubid)].index
-    trtdelta = trtdeltas[idSubid]
-    for match in submatches:
-      mzRt = matches.mzRt.at[match]
-      rtdelta = rtdeltas[mzRt]
-      matches.dtw.loc[match] = abs(DTW(trtdelta, rtdelta))
-
-  # Perform a queued match based on DTW score
-  idSubidQueue = idSubids.idSubid.tolist()
-  idSubidQueue.reverse()
-  while idSubidQueue:
-    idSubid = idSubidQueue.pop()
-    submatches = matches[(matches.idSubid == idSubid)].index
-    dtwBest = np.inf
-    mzRtBest = -1
-    matchBest = None
-    for match in submatches:
-      dtw = matches.dtw.at[match]
-      mzRt = matches.mzRt.at[match]
-      if dtw < dtwBest:
-        idSubidContest = mzRts.idSubid.iat[mzRt]
-        if idSubidContest == -1:
-          dtwBest = dtw
-          mzRtBest = mzRt
-          matchBest = match
-        # FOR LATER: consider validity of contest, especially for split peaks
-        elif dtw < matches.dtw.loc[(matches.idSubid == idSubidContest) & (matches.mzRt == mzRt)].iat[0]:
-          dtwBest = dtw
-          mzRtBest = mzRt
-          idSubids.mzRt.iat[idSubidContest] = -1
-          mzRts.idSubid.iat[mzRt] = -1
-          idSubidQueue.append(idSubidContest)
-    if mzRtBest > -1:
-      idSubids.mzRt.iat[idSubid] = mzRtBest
-      mzRts.idSubid.iat[mzRtBest] = idSubid
-      matches.flag.at[match] = 1
-
-  # return modified dataframes with match selections
-  return (matches, idSubids, mzRts)
-
-# Calculate inferred rt (irt) and delta rt (drt)
-# If drop, removes previous irt and drt
-# Modifies dataframes and returns a reasonable deltart bound (drtBound)
-def irtFilter(ids, idSubids, mzRts):
-  # If drop, removes the previous irt and drt
-  if "irt" in ids.columns:
-    ids.drop(columns="irt",inplace=True)
-    idSubids.drop(columns=["irt","drt","mz","rt"],inplace=True)
-
-  # Calculate inferred retention time per id (irt) as low median of the subid rts
-  # Calculate delta rt (drt) from abs(irt-rt)
-  # NOTE: right now the apply uses a "low median" method, but it's not clear
-  # that this is always best practice. a slightly more sophisticated method would
-  # look for a "better median" rather than a low one, so we'll try that later
-  irts = pd.merge(idSubids[idSubids.mzRt != -1], mzRts[mzRts.idSubid != -1],
-    on=["idSubid","mzRt"]).groupby("id")["rt"].apply(lambda x: x.sort_values().iat[int(len(x)/2 + len(x)%2)-1])
-  irts.name = "irt"
-  ids = pd.merge(ids, irts, on="id", how="left")
-  idSubids = pd.merge(idSubids, ids, on="id")
-  idSubids = pd.merge(idSubids, mzRts[["mzRt","mz","rt"]], on="mzRt", how="left")
-  idSubids["drt"] = abs(idSubids.irt - idSubids.rt)
-  idSubids = idSubids.sort_values(by="idSubid")
-
-  # mzRts should match idSubids
-  # print("mzRts: "  + str(len(mzRts[mzRts.idSubid != -1])))
-  # print("idSubids: "  + str(len(idSubids[idSubids.mzRt != -1])))
-
-  # Clean-up matches outside a reasonable rt bound
-  # Bound is approximated via double the 3rd quantile of deltart
-  drtBound = 2*idSubids[(~np.isnan(idSubids.drt)) & (idSubids.drt > 0)].drt.quantile(0.75)
-  if drtBound > drtMax:
-    drtBound = drtMax
-  return (ids, idSubids, drtBound)
-
-# Perform first shot matching based on rt
-# Get inferred rt and delta rt bound
-# Filter out matches outside delta rt bound
-def firstShot(matches, ids, idSubids, mzRts, drtBoundLimit = 0):
-  # Get best first-shot match based on rt
-  # Scan through unique ids to get all candidate matches
-  # Scan through unique subids to get all subcandidate matches
-  # Assign first free mzRt to idSubid in order of rt
-  # Link mzRt to idSubid for second shot matching
-  for id in ids.id:
-    #print("loop")
-    candidates = matches[(matches.id == id) & (matches.flag == 0)]
-    #print(candidates)
-    subids = idSubids[(idSubids.id == id) & (idSubids.mzRt == -1)].subid.unique()
-    #print(subids)
-    for i in range(0, len(subids)):
-      subid = subids[i]
-      subcandidates = candidates[candidates.subid == subid]
-      for j in subcandidates.index:
-        mzRt = subcandidates.mzRt[j]
-        idSubid = subcandidates.idSubid[j]
-        if mzRts.idSubid.iloc[mzRt] == -1:
-          mzRts.idSubid.iat[mzRt] = idSubid
-          idSubids.mzRt.iat[idSubid] = mzRt
-          matches.flag.at[j] = 2
-          break
-
-  # Calculate inferred retention time per id (irt) as median of the subid rts
-  # Calculate delta rt (drt) from abs(irt-rt)
-  # Get deltart bound (drtBound)
-  ids, idSubids, drtBound = irtFilter(ids, idSubids, mzRts)
-  # print("drtBound: " + str(drtBound))
-  if drtBoundLimit > drtBound:
-    drtBound = drtBoundLimit
-
-  # Clean-up matches outside a reasonable rt range
-  # Range is approximated via double the 3rd quantile of deltart
-  for i in idSubids[idSubids.drt > drtBound].index:
-    mzRt = idSubids.mzRt[i]
-    idSubid = idSubids.idSubid[i]
-    mzRts.idSubid.iat[mzRt] = -1
-    idSubids.mzRt.at[i] = -1
-    # NOTE: prior version only flags filtered results
-    # now we just just flag all prior assignments above
-    # this prevents getting "stuck" on single bad solution when running one-shot
-    # at the cost of potentially missing some matches that arise through corrections
-    # explore this later
-    # matches.flag.loc[(matches.mzRt == mzRt) & (matches.idSubid == idSubid)] = 1
-
-  # Drop outdated irt and drt and update
-  # We keep the same bound, as we want to avoid a filtering loop
-  # A mzRt candidate is a idSubid match within the drtBound
-  ids, idSubids, drtHypothesis = irtFilter(ids, idSubids, mzRts)
-  # print("drtHypothesis One: " + str(drtHypothesis))
-
-  # Return updated dataframes and bound
-  return (matches, ids, idSubids, mzRts, drtBound, drtHypothesis)
-
-# Perform second-shot correction of matches
-def secondShot(matches, ids, idSubids, mzRts, drtBound):
-  # Selection occurs in reverse rt order
-  # Method:
-  # 1. Check if idSubid slot is empty
-  # True:
-  #   2a. Check if there are any unassigned mzRt candidates
-  #   True:
-  #     3aa. Choose best (lowest drt) candidate to assign
-  #   False:
-  #     3ab. Check if there are any assigned mzRt candidates
-  #     4ab. Compare if better drt can be achieved
-  #     True:
-  #       5aba: Choose best (lowest drt) candidate to steal
-  # False:
-  #   2b. Check if there are any unassigned mzRt candidates with better drt
-  #   3b. Compare if better drt can be achieved
-  #   True:
-  #     4ba. Choose best (lowest drt) candidate to replace
-  for id in ids.id[~np.isnan(ids.irt)].iloc[::-1]:
-    candidates = matches[(matches.id == id)]
-    for i in idSubids.loc[idSubids.id == id].iloc[::-1].index:
-      subcandidates = candidates[candidates.subid == idSubids.subid[i]]
-      take = [-1, 0]
-      steal = [-1, 0]
-      if idSubids.mzRt[i] == -1:
-        for j in subcandidates.iloc[::-1].index:
-          mzRt = subcandidates.mzRt[j]
-          drt = abs(idSubids.irt[i] - mzRts.rt.iloc[mzRt])
-          if drt > drtBound:
-            continue
-          idSubid = mzRts.idSubid.iloc[mzRt]
-          if idSubid == -1 and (take[0] == -1 or take[1] > drt):
-            take = [mzRt, drt]
-          elif take[0] == -1 and idSubids.drt.iloc[idSubid] > drt and (steal[0] == -1 or steal[1] > drt):
-            steal = [mzRt, drt]
-        if take[0] != -1:
-          mzRts.idSubid.iloc[take[0]] = idSubids.idSubid[i]
-          idSubids.mzRt.loc[i] = take[0]
-          idSubids.drt.loc[i] = take[1]
-        elif steal[0] != -1:
-          mzRts.idSubid.iloc[take[0]] = idSubids.idSubid[i]
-          idSubid = mzRts.idSubid.iloc[steal[0]]
-          idSubids.mzRt.iloc[idSubid] = -1
-          idSubids.irt.iloc[idSubid] = -1
-          idSubids.drt.iloc[idSubid] = -1
-          idSubids.mzRt.loc[i] = steal[0]
-          idSubids.drt.loc[i] = steal[1]
-      else:
-        for j in subcandidates.iloc[::-1].index:
-          mzRt = subcandidates.mzRt[j]
-          drt = abs(idSubids.irt[i] - mzRts.rt.iloc[mzRt])
-          if drt > drtBound:
-            continue
-          idSubid = mzRts.idSubid.iloc[mzRt]
-          if idSubid == -1 and (take[0] == -1 or take[1] > drt):
-            take = [mzRt, drt]
-        if take[0] != -1 and idSubids.drt[i] > take[1]:
-          mzRts.idSubid.iloc[take[0]] = idSubids.idSubid[i]
-          idSubids.mzRt.loc[i] = take[0]
-          idSubids.drt.loc[i] = take[1]
-
-  # Update irt, get drtHypothesis
-  ids, idSubids, drtHypothesis = irtFilter(ids, idSubids, mzRts)
-
-  # Return updated dataframes and drtHypothesis
-  return (matches, ids, idSubids, mzRts, drtHypothesis)
-
-# Search for targets on a single sample
-def targetSearch(targets, sample, boundTestLimit = np.inf, dtw = True):
-  # Search original dataframe
-  # NOTE: in this implementation, Order and Fragment shares the same window as DTW
-  # this is not strictly necessary, though implementation of separate bounds is messy
-  matches = []
-  sample = sample[sample[sample.columns[2]] > 0]
-  for i in targets.index:
-    match = sample[(sample.mz <= targets.tmzupper[i]) & (sample.mz >= targets.tmzlower[i]) & (sample.rt <= targets.trtupper[i]) & (sample.rt >= targets.trtlower[i])]
-    if len(match) > 0:
-      match["id"] = targets.id[i]
-      match["subid"] = targets.subid[i]
-      match["trt"] = targets.trt[i]
-      match["tmz"] = targets.tmz[i]
-      matches.append(match)
-
-  # handle case of no-match
-  if len(matches) == 0:
-    print(sample.columns[2], " no-match")
-    return pd.DataFrame(columns=["id","subid","mz","rt",sample.columns[2],"tmz","trt"])
-
-  # Concatenate matches and sort by rt, irt, id, subid
-  # Get unique dataframe of matched mzRts and unique list of idSubids
-  matches = pd.concat(matches, axis=0).sort_values(["rt","trt","id","subid"])
-  # print(sample.columns[2], " initial matches: ", str(len(matches)))
-  mzRts = matches[["mz","rt"]].drop_duplicates()
-  idSubids = matches[["id","subid","trt"]].drop_duplicates()
-
-  # Add mzRt pk and idSubid to mzRts
-  # Add idSubid pk and mzRt to subIds
-  # Add mzRt to matches
-  mzRts["mzRt"] = range(0, len(mzRts))
-  idSubids["idSubid"] = range(0, len(idSubids))
-
-  # Add mzRt and idSubid to matches for quick indexing
-  # Cost is approximately O(n^2), could we do better?
-  # Sort may cost O(nlogn)
-  matches = pd.merge(matches, mzRts, on=["mz","rt"])
-  matches = pd.merge(matches, idSubids[["id","subid","idSubid"]], on=["id","subid"])
-  mzRts["idSubid"] = [-1]*len(mzRts)
-  idSubids["mzRt"] = [-1]*len(idSubids)
-  matches["dtw"] = [0]*len(matches)
-  matches["flag"] = [0]*len(matches) # not relevant yet
-
-  # Get unique dataframe of ids
-  # ids = idSubids[["id","trt"]].drop_duplicates()
-  ids = idSubids[["id"]].drop_duplicates()
-
-  # DTW Score based matching for initialization
-  if dtw:
-    matches, idSubids, mzRts = matchDTW(matches, idSubids, mzRts)
-
-  # Cycle through first shot matching
-  matchState = idSubids.mzRt[idSubids.mzRt != -1] # previously set to None
-  matchCount = matchState.count() # previously set to 0
-  drtBound = drtHypothesis = drtBoundLimit = 0
-  boundTest = 0
-  while True:
-    # print(sample.columns[2] + " matchCount: " + str(matchCount) + " drtBound: " + str(drtBound) + " ids: " + str(len(idSubids.index)))
-    if boundTest == boundTestLimit:
-      matches, ids, idSubids, mzRts, drtBound, drtHypothesis = firstShot(matches, ids, idSubids, mzRts, drtBoundLimit)
-    else:
-      matches, ids, idSubids, mzRts, drtBound, drtHypothesis = firstShot(matches, ids, idSubids, mzRts)
-      boundTest = boundTest + 1
-      drtBoundLimit = drtBound
-    newState = idSubids.mzRt[idSubids.mzRt != -1]
-    newCount = newState.count()
-    if newCount == matchCount:
-      if matchCount == 0 or matchState.equals(newState):
-        break
-    matchState = newState
-    matchCount = newCount
-
-  # print("drtBound: " + str(drtBound))
-  loglock.acquire()
-  with open(log, "a") as logfile:
-    logfile.write(str(drtBound) + "\n")
-  loglock.release()
-
-  # Second shot matching
-  matches, ids, idSubids, mzRts, drtHypothesis = secondShot(matches, ids, idSubids, mzRts, drtBound)
-  # print("drtHypothesis Two: " + str(drtHypothesis))
-
-  # Merge onto the original matches to filter final selection
-  matches = pd.merge(matches, idSubids[["idSubid","mzRt","irt","drt"]], on=["idSubid","mzRt"], how="inner")
-  # print(sample.columns[2], " done\n")
-  return matches[["id","subid","mz","rt",sample.columns[2],"tmz","trt","irt","drt"]]
-
-# Search directory for ADAP files
-# NOTE: Currently depth functionality is defunct
-def findADAP(dir, ADAP, depth):
-  for element in os.listdir(dir):
-    elementpath = os.path.join(dir, element)
-    if os.path.isfile(elementpath):
-      if len(element) > 4 and element[-4:] == ".csv":
-        ADAP.put(element)
-    elif depth < 0:
-      ADAP = findADAP(elementpath, ADAP, depth+1)
-  return ADAP
-
-# Estimate overall shift of list
-def shiftRt(targets, matches, trtSmallBound):
-  ids = matches["id"].unique()
-  shifts = []
-  rtShift= 0
-  for id in ids:
-    rts = matches.loc[matches["id"] == id, ["rt","trt"]]
-    if len(rts) >= 3:
-      shifts = shifts + rts["rt"].sub(rts["trt"]).tolist()
-  if len(shifts) > 0:
-    rtShift = pd.Series(shifts).median()
-    targets["trtupper"] = targets.trt.apply(lambda x: x+trtSmallBound+rtShift)
-    targets["trtlower"] = targets.trt.apply(lambda x: x-trtSmallBound+rtShift)
-  return [targets, rtShift]
-
-# Read metabolic features
-# Extract mz time information with label
-# Search for targets and get best match, sample by sample
-def runSample(targets, mzindex, rtindex, iindex, boundTestLimit, adapdir, ADAP, samples, lock, redundancy, dtw, shift, trtSmallBound):
-  lock.acquire()
-  if shift:
-    ortBounds = targets[["trtupper", "trtlower"]].copy()
-  while not ADAP.empty():
-    adap = ADAP.get()
-    lock.release()
-    sample = pd.read_csv(adapdir + "/" + adap).iloc[:,[mzindex,rtindex,iindex]]
-    sample.columns = ["mz","rt"]+[sample.columns[2].replace(redundancy, "")]
-    # matches = targetSearch(targets, sample, 1)
-    if shift:
-      matches = targetSearch(targets, sample, boundTestLimit, dtw)
-      targets, rtShift = shiftRt(targets, matches, trtSmallBound)
-      # print(adap + " " + str(rtShift))
-      matches = targetSearch(targets, sample, boundTestLimit, dtw)
-      targets[["trtupper","trtlower"]] = ortBounds[["trtupper", "trtlower"]]
-    else:
-      matches = targetSearch(targets, sample, boundTestLimit, dtw)
-    samples.put(matches)
-    lock.acquire()
-  lock.release()
-  return
-
-def main():
-  try:
-    opts, args = getopt.getopt(sys.argv[1:], "a:f:t:p:")
-  except getopt.GetoptError as err:
-    print(err)
-    sys.exit(2)
-  rawdir=None
-  adapdir=None
-  targetlist=None
-  processors=1
-  print(opts)
-  for o, a in opts:
-    if o == "-a":
-      print(a)
-      adapdir = os.path.abspath(a)
-    elif o == "-f":
-      print(a)
-      featuredir = os.path.abspath(a)
-    elif o == "-t":
-      print(a)
-      targetlist = os.path.abspath(a)
-    elif o == "-p":
-      print(a)
-      processors = int(a)
-    else:
-      print(o)
-      print(a)
-      print("unhandled option")
-      #sys.exit(2)
-  if not (adapdir and featuredir and targetlist):
-    print("missing options")
-    sys.exit(2)
-
-  # Get list of ADAP feature tables
-  ADAP = Queue()
-  ADAP=findADAP(adapdir, ADAP, 0)
-  sampleNum = ADAP.qsize()
-
-  # Set variables for reading file
-  # Indexes are for the sample files, not the target list
-  # NOTE: we need a good way to handle multiple target list formats
-  mzindex = 0
-  rtindex = 1
-  iindex = 3
-  redundancy = ".mzXML Peak area"
-
-  # Set variables for processing
-  boundTestLimit = 1 # this variable handles the number of times drtBound is optimized
-  trtBound = 0.3
-  trtSmallBound = 0.3
-  # trt = "min" # apparently mzmine output is in minutes
-  shift = True # parameter for whether we apply an automatic list shift
-  dtw = True # parameter for whether we start with dtw
-
-  # Read target list
-  # calculate deltappm range
-  targets = pd.read_csv(targetlist, sep=',')
-  #targets.columns=["id","name","tmz","trt","monoisotopic","cas","subid"]
-  targets.columns=["id","name","tmz","trt","monoisotopic","cas","subid","formula","concentration"]
-  #targets.columns=["id","name","tmz","trt","monoisotopic","cas","subid","formula","concentration","note","realRt"]
-  targets["tmzupper"] = targets.tmz.apply(lambda x: x+x*0.000006)
-  targets["tmzlower"] = targets.tmz.apply(lambda x: x-x*0.000006)
-  # if trt == "min":
-  #   targets.trt = targets.trt*60.0
-  targets["trtupper"] = targets.trt.apply(lambda x: x+trtBound)
-  targets["trtlower"] = targets.trt.apply(lambda x: x-trtBound)
-
-  # Set up and end processes for running samples
-  samples = Queue()
-  lock = Lock()
-  for p in range(0,processors):
-    worker = Process(target = runSample, args = (targets, mzindex, rtindex, iindex, boundTestLimit, adapdir, ADAP, samples, lock, redundancy, dtw, shift, trtSmallBound), daemon = True)
-    worker.start()
-
-  intensities = targets.copy()
-  rtimes = targets.copy()
-  masscharges = targets.copy()
-  # I recognize that the triple merge is inefficient here
-  # but I'm just gonna fix it later
-  while sampleNum > 0:
-    sampleNum = sampleNum - 1
-    sample = samples.get()
-    sampleId = sample.columns[4]
-    intensities = pd.merge(intensities, sample.iloc[:,[0,1,4]],on=["id","subid"],how="left")
-    sample.drop(columns=sampleId, inplace=True)
-    sample.rename(columns={"rt":sampleId}, inplace=True)
-    rtimes = pd.merge(rtimes, sample.iloc[:,[0,1,3]],on=["id","subid"],how="left")
-    sample.drop(columns=sampleId, inplace=True)
-    sample.rename(columns={"mz":sampleId}, inplace=True)
-    masscharges = pd.merge(masscharges, sample.iloc[:,[0,1,2]],on=["id","subid"],how="left")
-
-  intensities.fillna(0).to_csv(featuredir + "/" + "feature.sample.i.csv")
-  rtimes.fillna(0).to_csv(featuredir + "/" + "feature.sample.rt.csv")
-  masscharges.fillna(0).to_csv(featuredir + "/" + "feature.sample.mz.csv")
-
-if __name__ == "__main__":
-  main()
-
+#!/usr/bin/python3
+
+# os operation libraries
+import sys
+import os
+import getopt
+import time
+import json
+import resource
+import cProfile
+
+from multiprocessing import Process, Queue, Lock
+from multiprocessing import shared_memory
+
+# data libraries
+import numpy as np
+import matplotlib.pyplot as plt
+import pandas as pd
+import warnings
+warnings.filterwarnings('ignore')
+
+# import dtw
+import hashlib
+from fastdtw import fastdtw
+
+# feature store shared with GCSummary and GCQuant
+from featureStore import readFeatures, writeFeatures, openFeatures, closeFeatures
+
+# compiled target list index
+from targetIndex import loadTargets, openIndex, indexColumns
+
+# optional jit backend for the matching kernels
+try:
+  from numba import njit
+except ImportError:
+  njit = None
+
+# set global variables
+drtMax = 0.02
+
+# setup metrics
+# Each worker appends one JSON line per sample and library to its own file in the
+# metrics directory, see metricsReport.py; the stages are timed in seconds
+metricsName = "metrics"
+
+# set dtw kernel options
+dtwMethods = ["exact", "fastdtw"]
+dtwBatchSize = 256 # number of profile pairs scored per exact kernel call
+
+# set rt drift options
+# drift fits a per-sample rt correction before a single search, median is the
+# previous search, median shift and search again, none searches once unshifted
+shiftMethods = ["drift", "median", "none"]
+driftFragments = 3 # co-eluting fragments needed for an id to anchor the drift model
+driftKnots = 8 # most knots in the piecewise-linear drift model
+driftKnotAnchors = 5 # fewest anchors behind each knot
+driftGrid = 16 # trt points a sample drift curve is kept at for the batch model
+
+# DTW similarity score
+def DTW(trtdelta, rtdelta):
+  _, path = fastdtw(rtdelta, trtdelta)
+  length = max(len(rtdelta), len(trtdelta))
+  similarity = 1 - len(path) / length
+  return similarity
+
+# Exact DTW path lengths for a batch of equal length profile pairs
+# xs is (batch, m) and ys is (batch, n)
+# The cost matrix is swept one anti-diagonal at a time for all pairs at once
+# Ties are broken like fastdtw.dtw (vertical, then horizontal, then diagonal)
+def dtwPathLengths(xs, ys):
+  batch, m = xs.shape
+  n = ys.shape[1]
+  # diagonal arrays are indexed by the x position i of cell (i, k-i)
+  costPrev2 = np.full((batch, m+1), np.inf)
+  costPrev2[:, 0] = 0
+  lengthPrev2 = np.zeros((batch, m+1), dtype=np.int64)
+  costPrev = np.full((batch, m+1), np.inf)
+  lengthPrev = np.zeros((batch, m+1), dtype=np.int64)
+  for k in range(2, m+n+1):
+    i = np.arange(max(1, k-n), min(m, k-1)+1)
+    dt = np.abs(xs[:, i-1] - ys[:, k-i-1])
+    vertical = costPrev[:, i-1] + dt
+    horizontal = costPrev[:, i] + dt
+    diagonal = costPrev2[:, i-1] + dt
+    useVertical = (vertical <= horizontal) & (vertical <= diagonal)
+    useHorizontal = ~useVertical & (horizontal <= diagonal)
+    cost = np.full((batch, m+1), np.inf)
+    cost[:, i] = np.where(useVertical, vertical, np.where(useHorizontal, horizontal, diagonal))
+    length = np.zeros((batch, m+1), dtype=np.int64)
+    length[:, i] = np.where(useVertical, lengthPrev[:, i-1], np.where(useHorizontal, lengthPrev[:, i], lengthPrev2[:, i-1])) + 1
+    costPrev2, lengthPrev2, costPrev, lengthPrev = costPrev, lengthPrev, cost, length
+  return lengthPrev[:, m]
+
+# RT-delta profile of a sample
+# Keeps the rt (or trt) vector once as a compact float array with a content digest
+# Delta rows abs(values[k] - values) are only built for the rows being scored,
+# so memory grows with the number of candidates rather than its square
+def deltaProfile(values):
+  values = np.ascontiguousarray(values, dtype=float)
+  return (values, hashlib.blake2b(values.tobytes(), digest_size=16).digest())
+
+# Build the delta rows of a profile for a set of positions
+def deltaRows(profile, positions):
+  values = profile[0]
+  return abs(values[positions, None] - values)
+
+# DTW scoring engine
+# Scores a batch of candidates, each given by a position in the target profile
+# (trtProfile) and a position in the sample profile (rtProfile)
+# Scores are memoized in cache by profile content, so repeated searches
+# of the same sample (e.g. the shift pass and the final pass) reuse them
+# method is "exact" for the batched exact kernel or "fastdtw" for the approximation
+def scoreDTW(trtProfile, rtProfile, trtPositions, rtPositions, cache = None, method = "exact"):
+  if method not in dtwMethods:
+    raise ValueError("unknown dtw method: " + str(method))
+  if cache is None:
+    cache = {}
+
+  # Key candidates by profile content and find the ones not yet scored
+  # A delta row only depends on the profile and the value it is taken from
+  trtValues = trtProfile[0][trtPositions]
+  rtValues = rtProfile[0][rtPositions]
+  keys = []
+  pending = {}
+  for trtPosition, rtPosition, trtValue, rtValue in zip(trtPositions, rtPositions, trtValues, rtValues):
+    key = (method, trtProfile[1], trtValue, rtProfile[1], rtValue)
+    keys.append(key)
+    if key not in cache and key not in pending:
+      pending[key] = (trtPosition, rtPosition)
+
+  # Score pending candidates a batch of delta rows at a time
+  pendingKeys = list(pending.keys())
+  length = max(len(trtProfile[0]), len(rtProfile[0]))
+  for start in range(0, len(pendingKeys), dtwBatchSize):
+    batchKeys = pendingKeys[start:start+dtwBatchSize]
+    ys = deltaRows(trtProfile, np.array([pending[key][0] for key in batchKeys], dtype=int))
+    xs = deltaRows(rtProfile, np.array([pending[key][1] for key in batchKeys], dtype=int))
+    if method == "fastdtw":
+      similarities = [DTW(y, x) for x, y in zip(xs, ys)]
+    else:
+      similarities = 1 - dtwPathLengths(xs, ys) / length
+    for key, similarity in zip(batchKeys, similarities):
+      cache[key] = abs(similarity)
+
+  return np.array([cache[key] for key in keys], dtype=float)
+
+# Compile a matching kernel when numba is available
+# Kernels only loop over scalars in numpy arrays, so they also run as plain python
+def kernel(function):
+  if njit is None:
+    return function
+  return njit(function)
+
+# Compile the matching kernels up front
+# Called before workers are forked, so each worker does not compile them again
+def compileKernels():
+  if njit is None:
+    return
+  ints = np.zeros(0, dtype=np.int64)
+  floats = np.zeros(0)
+  flags = np.zeros(0, dtype=np.bool_)
+  starts = np.zeros(1, dtype=np.int64)
+  dtwQueueKernel(starts, ints, ints, floats, ints, ints, ints, flags)
+  irtKernel(starts, ints, ints, ints, ints, floats, flags, floats, floats, ints, flags, floats, floats, floats)
+  firstShotKernel(starts, ints, ints, starts, ints, ints, ints, ints, ints, ints, flags)
+  secondShotKernel(ints, starts, ints, ints, starts, ints, ints, floats, 0.0, ints, floats, floats, ints, flags)
+
+# Group positions by an integer code, keeping their order within each group
+# Group g is rows[starts[g]:starts[g+1]]
+def groupRows(codes, groupCount):
+  rows = np.argsort(codes, kind="stable").astype(np.int64)
+  starts = np.zeros(groupCount+1, dtype=np.int64)
+  starts[1:] = np.cumsum(np.bincount(codes, minlength=groupCount))
+  return (starts, rows)
+
+# Build the array-backed matching state of a single sample
+# idSubid and mzRt arrays are indexed by their primary keys, match arrays follow the rows of matches
+# Assignments are kept both ways (idSubidMzRt and mzRtIdSubid) and may disagree,
+# in which case the pair does not count towards the inferred rt
+# Kernels mark every idSubid whose assignment they touch in idSubidTouched,
+# so irtFilter only has to revisit those idSubids and their ids
+def searchState(matches, idSubids, mzRts):
+  idCodes, idValues = pd.factorize(idSubids.id)
+  pairCodes = idSubids.groupby(["id","subid"], sort=False).ngroup().to_numpy(dtype=np.int64)
+  matchIdSubid = matches.idSubid.to_numpy(dtype=np.int64, copy=True)
+  state = {
+    "ids": np.asarray(idValues),
+    "idIrt": np.full(len(idValues), np.nan),
+    "idSubidId": idCodes.astype(np.int64),
+    "idSubidPair": pairCodes,
+    "idSubidTrt": idSubids.trt.to_numpy(dtype=float, copy=True),
+    "idSubidMzRt": np.full(len(idSubids), -1, dtype=np.int64),
+    "idSubidIrt": np.full(len(idSubids), np.nan),
+    "idSubidDrt": np.full(len(idSubids), np.nan),
+    "idSubidTouched": np.ones(len(idSubids), dtype=np.bool_),
+    "idSubidRt": np.full(len(idSubids), np.nan),
+    "idRts": np.zeros(len(idSubids)),
+    "idRtCounts": np.zeros(len(idValues), dtype=np.int64),
+    "idDirty": np.zeros(len(idValues), dtype=np.bool_),
+    "mzRtRt": mzRts.rt.to_numpy(dtype=float, copy=True),
+    "mzRtIdSubid": np.full(len(mzRts), -1, dtype=np.int64),
+    "matchIdSubid": matchIdSubid,
+    "matchMzRt": matches.mzRt.to_numpy(dtype=np.int64, copy=True),
+    "matchDtw": np.zeros(len(matches)),
+    "matchFlag": np.zeros(len(matches), dtype=np.int64)
+  }
+  # idSubids per id, matches per (id, subid) and matches per idSubid
+  # idRts holds the sorted rts of the consistently assigned idSubids of each id,
+  # in the slots idStarts[id]:idStarts[id]+idRtCounts[id]
+  state["idStarts"], state["idRows"] = groupRows(state["idSubidId"], len(idValues))
+  state["pairStarts"], state["pairRows"] = groupRows(pairCodes[matchIdSubid], pairCodes.max()+1)
+  state["idSubidStarts"], state["idSubidRows"] = groupRows(matchIdSubid, len(idSubids))
+  return state
+
+# Queued matching kernel on DTW scores
+# Each idSubid takes its best scoring free mzRt, or steals one it scores better on
+# An idSubid that loses its mzRt is queued again right away
+@kernel
+def dtwQueueKernel(idSubidStarts, idSubidRows, matchMzRt, matchDtw, matchFlag, idSubidMzRt, mzRtIdSubid, idSubidTouched):
+  idSubidQueue = list(range(len(idSubidMzRt)-1, -1, -1))
+  while len(idSubidQueue) > 0:
+    idSubid = idSubidQueue.pop()
+    dtwBest = np.inf
+    mzRtBest = -1
+    match = -1
+    for r in range(idSubidStarts[idSubid], idSubidStarts[idSubid+1]):
+      match = idSubidRows[r]
+      dtw = matchDtw[match]
+      mzRt = matchMzRt[match]
+      if dtw < dtwBest:
+        idSubidContest = mzRtIdSubid[mzRt]
+        if idSubidContest == -1:
+          dtwBest = dtw
+          mzRtBest = mzRt
+        else:
+          # FOR LATER: consider validity of contest, especially for split peaks
+          dtwContest = np.nan
+          for c in range(idSubidStarts[idSubidContest], idSubidStarts[idSubidContest+1]):
+            if matchMzRt[idSubidRows[c]] == mzRt:
+              dtwContest = matchDtw[idSubidRows[c]]
+              break
+          if dtw < dtwContest:
+            dtwBest = dtw
+            mzRtBest = mzRt
+            idSubidMzRt[idSubidContest] = -1
+            mzRtIdSubid[mzRt] = -1
+            idSubidTouched[idSubidContest] = True
+            idSubidQueue.append(idSubidContest)
+    if mzRtBest > -1:
+      idSubidMzRt[idSubid] = mzRtBest
+      mzRtIdSubid[mzRtBest] = idSubid
+      idSubidTouched[idSubid] = True
+      # NOTE: this flags the last candidate of the idSubid rather than the selected one
+      # kept as is, since firstShot skips flagged candidates
+      matchFlag[match] = 1
+
+# Search for targets on a single sample
+# using DWT criteria
+def matchDTW(state, dtwCache = None, dtwMethod = "exact"):
+  # Get relative distance profiles for targets and matches
+  trtProfile = deltaProfile(state["idSubidTrt"])
+  rtProfile = deltaProfile(state["mzRtRt"])
+
+  # Get DWT scores for all relevant matches in one batch
+  state["matchDtw"] = scoreDTW(trtProfile, rtProfile, state["matchIdSubid"], state["matchMzRt"], dtwCache, dtwMethod)
+
+  # Perform a queued match based on DTW score
+  dtwQueueKernel(state["idSubidStarts"], state["idSubidRows"], state["matchMzRt"], state["matchDtw"],
+    state["matchFlag"], state["idSubidMzRt"], state["mzRtIdSubid"], state["idSubidTouched"])
+  return state
+
+# Inferred rt kernel
+# Only touched idSubids are revisited: their rt is moved in or out of the sorted rts of their id
+# irt per id is the low median of the rts of its consistently assigned idSubids
+# drt per idSubid is abs(irt-rt), nan when unassigned or without irt
+# Both are only recomputed for ids with a touched idSubid
+@kernel
+def irtKernel(idStarts, idRows, idSubidId, idSubidMzRt, mzRtIdSubid, mzRtRt, idSubidTouched, idSubidRt, idRts, idRtCounts, idDirty, idIrt, idSubidIrt, idSubidDrt):
+  for idSubid in range(len(idSubidMzRt)):
+    if not idSubidTouched[idSubid]:
+      continue
+    idSubidTouched[idSubid] = False
+    id = idSubidId[idSubid]
+    idDirty[id] = True
+    mzRt = idSubidMzRt[idSubid]
+    rt = np.nan
+    if mzRt != -1 and mzRtIdSubid[mzRt] == idSubid:
+      rt = mzRtRt[mzRt]
+    rtPrev = idSubidRt[idSubid]
+    if rt == rtPrev or (np.isnan(rt) and np.isnan(rtPrev)):
+      continue
+    start = idStarts[id]
+    count = idRtCounts[id]
+    # remove the previous rt from the sorted rts of the id
+    if not np.isnan(rtPrev):
+      i = start + np.searchsorted(idRts[start:start+count], rtPrev)
+      idRts[i:start+count-1] = idRts[i+1:start+count].copy()
+      count -= 1
+    # insert the new rt into the sorted rts of the id
+    if not np.isnan(rt):
+      i = start + np.searchsorted(idRts[start:start+count], rt)
+      idRts[i+1:start+count+1] = idRts[i:start+count].copy()
+      idRts[i] = rt
+      count += 1
+    idRtCounts[id] = count
+    idSubidRt[idSubid] = rt
+  for id in range(len(idStarts)-1):
+    if not idDirty[id]:
+      continue
+    idDirty[id] = False
+    count = idRtCounts[id]
+    if count > 0:
+      idIrt[id] = idRts[idStarts[id]+(count+1)//2-1]
+    else:
+      idIrt[id] = np.nan
+    for r in range(idStarts[id], idStarts[id+1]):
+      idSubid = idRows[r]
+      idSubidIrt[idSubid] = idIrt[id]
+      mzRt = idSubidMzRt[idSubid]
+      if mzRt == -1:
+        idSubidDrt[idSubid] = np.nan
+      else:
+        idSubidDrt[idSubid] = abs(idIrt[id] - mzRtRt[mzRt])
+
+# Calculate inferred rt (irt) and delta rt (drt)
+# Updates irt and drt in the state for ids whose assignments changed
+# Returns a reasonable deltart bound (drtBound)
+def irtFilter(state):
+  # Calculate inferred retention time per id (irt) as low median of the subid rts
+  # Calculate delta rt (drt) from abs(irt-rt)
+  # NOTE: right now this uses a "low median" method, but it's not clear
+  # that this is always best practice. a slightly more sophisticated method would
+  # look for a "better median" rather than a low one, so we'll try that later
+  irtKernel(state["idStarts"], state["idRows"], state["idSubidId"], state["idSubidMzRt"], state["mzRtIdSubid"], state["mzRtRt"],
+    state["idSubidTouched"], state["idSubidRt"], state["idRts"], state["idRtCounts"], state["idDirty"],
+    state["idIrt"], state["idSubidIrt"], state["idSubidDrt"])
+
+  # Clean-up matches outside a reasonable rt bound
+  # Bound is approximated via double the 3rd quantile of deltart
+  drts = state["idSubidDrt"]
+  drts = drts[(~np.isnan(drts)) & (drts > 0)]
+  drtBound = 2*np.percentile(drts, 75) if len(drts) > 0 else np.nan
+  if drtBound > drtMax:
+    drtBound = drtMax
+  return drtBound
+
+# First shot kernel
+# Scans through ids, then through the subids that are still free
+# Assigns the first free, unflagged mzRt candidate in order of rt
+@kernel
+def firstShotKernel(idStarts, idRows, idSubidPair, pairStarts, pairRows, matchIdSubid, matchMzRt, matchFlag, idSubidMzRt, mzRtIdSubid, idSubidTouched):
+  pairs = np.empty(len(idSubidPair), dtype=np.int64)
+  for id in range(len(idStarts)-1):
+    # unique subids of the id that are still unassigned
+    pairCount = 0
+    for r in range(idStarts[id], idStarts[id+1]):
+      idSubid = idRows[r]
+      if idSubidMzRt[idSubid] == -1:
+        pair = idSubidPair[idSubid]
+        seen = False
+        for p in range(pairCount):
+          if pairs[p] == pair:
+            seen = True
+            break
+        if not seen:
+          pairs[pairCount] = pair
+          pairCount += 1
+    for p in range(pairCount):
+      pair = pairs[p]
+      for r in range(pairStarts[pair], pairStarts[pair+1]):
+        match = pairRows[r]
+        if matchFlag[match] != 0:
+          continue
+        mzRt = matchMzRt[match]
+        if mzRtIdSubid[mzRt] == -1:
+          idSubid = matchIdSubid[match]
+          mzRtIdSubid[mzRt] = idSubid
+          idSubidMzRt[idSubid] = mzRt
+          idSubidTouched[idSubid] = True
+          matchFlag[match] = 2
+          break
+
+# Perform first shot matching based on rt
+# Get inferred rt and delta rt bound
+# Filter out matches outside delta rt bound
+def firstShot(state, drtBoundLimit = 0):
+  # Get best first-shot match based on rt
+  # Link mzRt to idSubid for second shot matching
+  firstShotKernel(state["idStarts"], state["idRows"], state["idSubidPair"], state["pairStarts"], state["pairRows"],
+    state["matchIdSubid"], state["matchMzRt"], state["matchFlag"], state["idSubidMzRt"], state["mzRtIdSubid"], state["idSubidTouched"])
+
+  # Calculate inferred retention time per id (irt) as median of the subid rts
+  # Calculate delta rt (drt) from abs(irt-rt)
+  # Get deltart bound (drtBound)
+  drtBound = irtFilter(state)
+  # print("drtBound: " + str(drtBound))
+  if drtBoundLimit > drtBound:
+    drtBound = drtBoundLimit
+
+  # Clean-up matches outside a reasonable rt range
+  # Range is approximated via double the 3rd quantile of deltart
+  # NOTE: prior version only flags filtered results
+  # now we just just flag all prior assignments above
+  # this prevents getting "stuck" on single bad solution when running one-shot
+  # at the cost of potentially missing some matches that arise through corrections
+  # explore this later
+  outside = state["idSubidDrt"] > drtBound
+  owners = state["mzRtIdSubid"][state["idSubidMzRt"][outside]]
+  state["idSubidTouched"][owners[owners != -1]] = True
+  state["idSubidTouched"][outside] = True
+  state["mzRtIdSubid"][state["idSubidMzRt"][outside]] = -1
+  state["idSubidMzRt"][outside] = -1
+
+  # Update irt and drt
+  # We keep the same bound, as we want to avoid a filtering loop
+  # A mzRt candidate is a idSubid match within the drtBound
+  drtHypothesis = irtFilter(state)
+  # print("drtHypothesis One: " + str(drtHypothesis))
+
+  # Return updated bound
+  return (drtBound, drtHypothesis)
+
+# Second shot kernel
+# Selection occurs in reverse rt order
+# Method:
+# 1. Check if idSubid slot is empty
+# True:
+#   2a. Check if there are any unassigned mzRt candidates
+#   True:
+#     3aa. Choose best (lowest drt) candidate to assign
+#   False:
+#     3ab. Check if there are any assigned mzRt candidates
+#     4ab. Compare if better drt can be achieved
+#     True:
+#       5aba: Choose best (lowest drt) candidate to steal
+# False:
+#   2b. Check if there are any unassigned mzRt candidates with better drt
+#   3b. Compare if better drt can be achieved
+#   True:
+#     4ba. Choose best (lowest drt) candidate to replace
+@kernel
+def secondShotKernel(idOrder, idStarts, idRows, idSubidPair, pairStarts, pairRows, matchMzRt, mzRtRt, drtBound, idSubidMzRt, idSubidIrt, idSubidDrt, mzRtIdSubid, idSubidTouched):
+  for id in idOrder:
+    for r in range(idStarts[id+1]-1, idStarts[id]-1, -1):
+      idSubid = idRows[r]
+      pair = idSubidPair[idSubid]
+      take = -1
+      takeDrt = 0.0
+      steal = -1
+      stealDrt = 0.0
+      if idSubidMzRt[idSubid] == -1:
+        for c in range(pairStarts[pair+1]-1, pairStarts[pair]-1, -1):
+          mzRt = matchMzRt[pairRows[c]]
+          drt = abs(idSubidIrt[idSubid] - mzRtRt[mzRt])
+          if drt > drtBound:
+            continue
+          idSubidOwner = mzRtIdSubid[mzRt]
+          if idSubidOwner == -1 and (take == -1 or takeDrt > drt):
+            take = mzRt
+            takeDrt = drt
+          elif take == -1 and idSubidDrt[idSubidOwner] > drt and (steal == -1 or stealDrt > drt):
+            steal = mzRt
+            stealDrt = drt
+        if take != -1:
+          mzRtIdSubid[take] = idSubid
+          idSubidMzRt[idSubid] = take
+          idSubidDrt[idSubid] = takeDrt
+          idSubidTouched[idSubid] = True
+        elif steal != -1:
+          # NOTE: the stealing idSubid is written to the last mzRt (the unset take slot)
+          # and the stolen mzRt keeps pointing at its previous owner
+          # kept as is to preserve existing results, revisit with the steal logic
+          if mzRtIdSubid[len(mzRtIdSubid)-1] != -1:
+            idSubidTouched[mzRtIdSubid[len(mzRtIdSubid)-1]] = True
+          mzRtIdSubid[len(mzRtIdSubid)-1] = idSubid
+          idSubidOwner = mzRtIdSubid[steal]
+          idSubidMzRt[idSubidOwner] = -1
+          idSubidIrt[idSubidOwner] = -1
+          idSubidDrt[idSubidOwner] = -1
+          idSubidMzRt[idSubid] = steal
+          idSubidDrt[idSubid] = stealDrt
+          idSubidTouched[idSubidOwner] = True
+          idSubidTouched[idSubid] = True
+      else:
+        for c in range(pairStarts[pair+1]-1, pairStarts[pair]-1, -1):
+          mzRt = matchMzRt[pairRows[c]]
+          drt = abs(idSubidIrt[idSubid] - mzRtRt[mzRt])
+          if drt > drtBound:
+            continue
+          idSubidOwner = mzRtIdSubid[mzRt]
+          if idSubidOwner == -1 and (take == -1 or takeDrt > drt):
+            take = mzRt
+            takeDrt = drt
+        if take != -1 and idSubidDrt[idSubid] > takeDrt:
+          mzRtIdSubid[take] = idSubid
+          idSubidMzRt[idSubid] = take
+          idSubidDrt[idSubid] = takeDrt
+          idSubidTouched[idSubid] = True
+
+# Perform second-shot correction of matches
+def secondShot(state, drtBound):
+  # Ids with an inferred rt, in reverse order
+  idOrder = np.flatnonzero(~np.isnan(state["idIrt"]))[::-1].copy()
+  secondShotKernel(idOrder, state["idStarts"], state["idRows"], state["idSubidPair"], state["pairStarts"], state["pairRows"],
+    state["matchMzRt"], state["mzRtRt"], float(drtBound), state["idSubidMzRt"], state["idSubidIrt"], state["idSubidDrt"], state["mzRtIdSubid"],
+    state["idSubidTouched"])
+
+  # Update irt, get drtHypothesis
+  drtHypothesis = irtFilter(state)
+
+  # Return drtHypothesis
+  return drtHypothesis
+
+# Find candidate features for every target in one pass
+# The sample is sorted by mz once and each target mz window is located via binary search
+# Candidates in the mz window are then checked against the target rt window
+# Rows are returned in target order, then sample order, same as a per-target mask
+# With a compiled mzIndex of (target order, sorted lower bounds, upper bounds, widest window)
+# each sample feature is located among the target windows instead, and no sort is needed
+def candidateSearch(targets, sample, mzIndex = None):
+  mz = sample.mz.to_numpy()
+  rt = sample.rt.to_numpy()
+  if mzIndex is None:
+    mzOrder = np.argsort(mz, kind="stable")
+    mzSorted = mz[mzOrder]
+    lower = np.searchsorted(mzSorted, targets.tmzlower.to_numpy(), side="left")
+    upper = np.searchsorted(mzSorted, targets.tmzupper.to_numpy(), side="right")
+    counts = np.maximum(upper - lower, 0)
+
+    # Expand the mz windows into flat (target, sample) position pairs
+    targetPos = np.repeat(np.arange(len(targets)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    samplePos = mzOrder[np.repeat(lower, counts) + offsets]
+  else:
+    # Targets whose lower bound lies within (twice) the widest window below the feature mz
+    # are the only ones that can hold it; the exact bounds are checked after expanding
+    targetOrder, mzLower, mzUpper, mzWidth = mzIndex
+    first = np.searchsorted(mzLower, mz - 2*mzWidth, side="left")
+    last = np.searchsorted(mzLower, mz, side="right")
+    counts = last - first
+    samplePos = np.repeat(np.arange(len(mz)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    windows = np.repeat(first, counts) + offsets
+    inWindow = (mzLower[windows] <= mz[samplePos]) & (mzUpper[windows] >= mz[samplePos])
+    targetPos = targetOrder[windows[inWindow]]
+    samplePos = samplePos[inWindow]
+
+  # Filter on the rt window and restore sample order within each target
+  inWindow = (rt[samplePos] <= targets.trtupper.to_numpy()[targetPos]) & (rt[samplePos] >= targets.trtlower.to_numpy()[targetPos])
+  targetPos = targetPos[inWindow]
+  samplePos = samplePos[inWindow]
+  order = np.lexsort((samplePos, targetPos))
+  targetPos = targetPos[order]
+  samplePos = samplePos[order]
+
+  # Build the candidate frame in one go
+  matches = sample.iloc[samplePos].copy()
+  matches["id"] = targets.id.to_numpy()[targetPos]
+  matches["subid"] = targets.subid.to_numpy()[targetPos]
+  matches["trt"] = targets.trt.to_numpy()[targetPos]
+  matches["tmz"] = targets.tmz.to_numpy()[targetPos]
+  return matches
+
+# Add to the metrics of a sample, when kept
+# A stage adds the time since started and returns the time it ended, so stages chain;
+# a count is added as is
+def addMetric(metrics, key, started = None, count = None):
+  now = time.perf_counter()
+  if metrics is not None:
+    metrics[key] = metrics.get(key, 0) + (count if count is not None else now - started)
+  return now
+
+# Key candidate matches for the matching state
+# Returns the matches, their unique idSubids and their unique mzRts, each with its key
+def searchFrames(matches):
+  # Sort by rt, irt, id, subid
+  # Get unique dataframe of matched mzRts and unique list of idSubids
+  matches = matches.sort_values(["rt","trt","id","subid"])
+  mzRts = matches[["mz","rt"]].drop_duplicates()
+  idSubids = matches[["id","subid","trt"]].drop_duplicates()
+
+  # Add mzRt pk to mzRts
+  # Add idSubid pk to subIds
+  mzRts["mzRt"] = range(0, len(mzRts))
+  idSubids["idSubid"] = range(0, len(idSubids))
+
+  # Add mzRt and idSubid to matches for quick indexing
+  matches = pd.merge(matches, mzRts, on=["mz","rt"])
+  matches = pd.merge(matches, idSubids[["id","subid","idSubid"]], on=["id","subid"])
+  return (matches, idSubids, mzRts)
+
+# Search for targets on a single sample
+# Stage times and counts are added to metrics when given, see addMetric
+def targetSearch(targets, sample, boundTestLimit = np.inf, dtw = True, dtwCache = None, dtwMethod = "exact", mzIndex = None, metrics = None):
+  # Search original dataframe
+  # NOTE: in this implementation, Order and Fragment shares the same window as DTW
+  # this is not strictly necessary, though implementation of separate bounds is messy
+  started = time.perf_counter()
+  sample = sample[sample[sample.columns[2]] > 0]
+  matches = candidateSearch(targets, sample, mzIndex)
+  started = addMetric(metrics, "candidateSearch", started)
+  addMetric(metrics, "searches", count = 1)
+  addMetric(metrics, "features", count = len(sample))
+  addMetric(metrics, "candidates", count = len(matches))
+
+  # handle case of no-match
+  if len(matches) == 0:
+    print(sample.columns[2], " no-match")
+    return pd.DataFrame(columns=["id","subid","mz","rt",sample.columns[2],"tmz","trt"])
+
+  # Key the candidates by mzRt and idSubid
+  # print(sample.columns[2], " initial matches: ", str(len(matches)))
+  matches, idSubids, mzRts = searchFrames(matches)
+
+  # Move the matching state into arrays
+  state = searchState(matches, idSubids, mzRts)
+  started = addMetric(metrics, "searchState", started)
+
+  # DTW Score based matching for initialization
+  if dtw:
+    matchDTW(state, dtwCache, dtwMethod)
+    started = addMetric(metrics, "dtw", started)
+
+  # Cycle through first shot matching
+  # A match state is the assigned idSubids and their mzRts
+  # NOTE: the starting state is labelled by the idSubids frame index rather than by idSubid,
+  # matching how the previous pandas state compared against the filtered state
+  assigned = state["idSubidMzRt"] != -1
+  matchState = (idSubids.index.to_numpy()[assigned], state["idSubidMzRt"][assigned].copy())
+  matchCount = len(matchState[1])
+  drtBound = drtHypothesis = drtBoundLimit = 0
+  boundTest = 0
+  while True:
+    addMetric(metrics, "firstShotIterations", count = 1)
+    # print(sample.columns[2] + " matchCount: " + str(matchCount) + " drtBound: " + str(drtBound) + " ids: " + str(len(idSubids.index)))
+    if boundTest == boundTestLimit:
+      drtBound, drtHypothesis = firstShot(state, drtBoundLimit)
+    else:
+      drtBound, drtHypothesis = firstShot(state)
+      boundTest = boundTest + 1
+      drtBoundLimit = drtBound
+    assigned = state["idSubidMzRt"] != -1
+    newState = (np.flatnonzero(assigned), state["idSubidMzRt"][assigned].copy())
+    newCount = len(newState[1])
+    if newCount == matchCount:
+      if matchCount == 0 or (np.array_equal(matchState[0], newState[0]) and np.array_equal(matchState[1], newState[1])):
+        break
+    matchState = newState
+    matchCount = newCount
+
+  # print("drtBound: " + str(drtBound))
+  started = addMetric(metrics, "firstShot", started)
+  if metrics is not None:
+    metrics.setdefault("drtBound", []).append(float(drtBound))
+
+  # Second shot matching
+  drtHypothesis = secondShot(state, drtBound)
+  started = addMetric(metrics, "secondShot", started)
+  # print("drtHypothesis Two: " + str(drtHypothesis))
+
+  # Filter the original matches to the final selection
+  matchIdSubid = state["matchIdSubid"]
+  selected = state["matchMzRt"] == state["idSubidMzRt"][matchIdSubid]
+  matches = matches[selected].reset_index(drop=True)
+  matches["irt"] = state["idSubidIrt"][matchIdSubid[selected]]
+  matches["drt"] = state["idSubidDrt"][matchIdSubid[selected]]
+  addMetric(metrics, "matched", count = len(matches))
+  # print(sample.columns[2], " done\n")
+  return matches[["id","subid","mz","rt",sample.columns[2],"tmz","trt","irt","drt"]]
+
+# Search directory for ADAP files
+# NOTE: Currently depth functionality is defunct
+def findADAP(dir, ADAP, depth):
+  for element in os.listdir(dir):
+    elementpath = os.path.join(dir, element)
+    if os.path.isfile(elementpath):
+      if len(element) > 4 and element[-4:] == ".csv":
+        ADAP.put(element)
+    elif depth < 0:
+      ADAP = findADAP(elementpath, ADAP, depth+1)
+  return ADAP
+
+# Estimate overall shift of list
+def shiftRt(targets, matches, trtSmallBound):
+  ids = matches["id"].unique()
+  shifts = []
+  rtShift= 0
+  for id in ids:
+    rts = matches.loc[matches["id"] == id, ["rt","trt"]]
+    if len(rts) >= 3:
+      shifts = shifts + rts["rt"].sub(rts["trt"]).tolist()
+  if len(shifts) > 0:
+    rtShift = pd.Series(shifts).median()
+    targets["trtupper"] = targets.trt.apply(lambda x: x+trtSmallBound+rtShift)
+    targets["trtlower"] = targets.trt.apply(lambda x: x-trtSmallBound+rtShift)
+  return [targets, rtShift]
+
+# Find drift anchors in a sample without a full search
+# Candidates come from the target windows; for every id the rt window of width drtMax
+# holding the most distinct fragments is taken, and the id anchors the model when
+# that window holds at least driftFragments of them
+# Returns the trt and the observed rt (window median) of every anchor
+def driftAnchors(targets, sample, mzIndex = None):
+  sample = sample[sample[sample.columns[2]] > 0]
+  matches = candidateSearch(targets, sample, mzIndex)
+  ids = matches.id.to_numpy()
+  order = np.lexsort((matches.rt.to_numpy(), ids))
+  ids = ids[order]
+  subids = matches.subid.to_numpy()[order]
+  rts = matches.rt.to_numpy()[order]
+  trts = matches.trt.to_numpy()[order]
+  starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) > 0 else np.zeros(0, dtype=int)
+  stops = np.r_[starts[1:], len(ids)]
+  anchorTrt = []
+  anchorRt = []
+  for start, stop in zip(starts, stops):
+    if len(np.unique(subids[start:stop])) < driftFragments:
+      continue
+    idRts = rts[start:stop]
+    ends = np.searchsorted(idRts, idRts + drtMax, side="right")
+    counts = [len(np.unique(subids[start+i:start+end])) for i, end in enumerate(ends)]
+    best = int(np.argmax(counts))
+    if counts[best] >= driftFragments:
+      anchorTrt.append(np.median(trts[start+best:start+ends[best]]))
+      anchorRt.append(np.median(idRts[best:ends[best]]))
+  return np.array(anchorTrt), np.array(anchorRt)
+
+# Fit a monotone piecewise-linear rt correction from drift anchors
+# Anchors are split by trt into equal-count bins, at most driftKnots of them and
+# at least driftKnotAnchors anchors each; a bin gives a knot at its median trt and
+# median offset, and knot rts are made non-decreasing so the correction keeps elution order
+# Returns knot trts and offsets; offsets are held constant past the end knots
+def driftModel(anchorTrt, anchorRt):
+  order = np.argsort(anchorTrt, kind="stable")
+  bins = np.array_split(order, max(1, min(driftKnots, len(order) // driftKnotAnchors)))
+  knotTrt = np.array([np.median(anchorTrt[b]) for b in bins])
+  knotOffset = np.array([np.median(anchorRt[b] - anchorTrt[b]) for b in bins])
+  knotTrt, first = np.unique(knotTrt, return_index=True)
+  knotRt = np.maximum.accumulate(knotTrt + knotOffset[first])
+  return knotTrt, knotRt - knotTrt
+
+# Move the target windows onto trt plus per-target rt shifts
+def shiftWindows(targets, rtShifts, trtSmallBound):
+  targets["trtupper"] = targets.trt.to_numpy(dtype=float) + trtSmallBound + rtShifts
+  targets["trtlower"] = targets.trt.to_numpy(dtype=float) - trtSmallBound + rtShifts
+  return targets
+
+# Estimate the rt drift of a sample and move the target windows onto it
+# Anchors are looked for in the current target windows
+# Returns the targets and the (knot trts, knot offsets) drift model, None without anchors
+# Like shiftRt, targets are left as they are when the sample has no anchors
+def driftRt(targets, sample, trtSmallBound, mzIndex = None):
+  anchorTrt, anchorRt = driftAnchors(targets, sample, mzIndex)
+  if len(anchorTrt) == 0:
+    return [targets, None]
+  knotTrt, knotOffset = driftModel(anchorTrt, anchorRt)
+  targets = shiftWindows(targets, np.interp(targets.trt.to_numpy(dtype=float), knotTrt, knotOffset), trtSmallBound)
+  return [targets, (knotTrt, knotOffset)]
+
+# Fit the drift model of a searched sample from its final matches
+# ids with at least driftFragments matched fragments anchor it at their median rt
+# Returns None when no id has enough matched fragments
+def matchDrift(matches):
+  if len(matches) == 0:
+    return None
+  ids = matches.groupby("id").agg(count=("subid", "size"), trt=("trt", "median"), rt=("rt", "median"))
+  ids = ids[ids["count"] >= driftFragments]
+  if len(ids) == 0:
+    return None
+  return driftModel(ids.trt.to_numpy(dtype=float), ids.rt.to_numpy(dtype=float))
+
+# Predict the drift curve of the sample at an injection position from the rest of its batch
+# Drift curves are rows of offsets at the driftGrid trts, NaN until a sample is done
+# Curves already seen in the same batch are interpolated linearly in injection order
+# between the nearest done injections on either side, and extrapolated along the line
+# through the nearest two when the position is outside them
+# Returns None while no other sample of the batch is done
+def batchDrift(driftCurves, driftBatches, position):
+  done = ~np.isnan(driftCurves).any(axis=1)
+  done[position] = False
+  observed = np.flatnonzero(done & (driftBatches == driftBatches[position]))
+  if len(observed) == 0:
+    return None
+  if len(observed) == 1:
+    return driftCurves[observed[0]].copy()
+  after = np.searchsorted(observed, position)
+  if after == 0:
+    first, second = observed[0], observed[1]
+  elif after == len(observed):
+    first, second = observed[-2], observed[-1]
+  else:
+    first, second = observed[after-1], observed[after]
+  weight = (position - first) / (second - first)
+  return driftCurves[first] + weight * (driftCurves[second] - driftCurves[first])
+
+# Read the mz, rt and intensity columns of an ADAP feature table
+# Only those three columns are parsed, as floats
+# A columnar sidecar (<adap>.npz) is kept next to the csv and reused
+# for as long as the size and mtime of the csv match
+def readADAP(path, mzindex, rtindex, iindex, cache = True):
+  columns = [mzindex, rtindex, iindex]
+  stat = os.stat(path)
+  sidecar = path + ".npz"
+  if cache and os.path.isfile(sidecar):
+    try:
+      with np.load(sidecar, allow_pickle=False) as stored:
+        if stored["stat"].tolist() == [stat.st_size, stat.st_mtime_ns] and stored["columns"].tolist() == columns:
+          names = stored["names"].tolist()
+          return pd.DataFrame({names[0]: stored["mz"], names[1]: stored["rt"], names[2]: stored["i"]})[names]
+    except (OSError, ValueError, KeyError):
+      pass
+
+  # Parse the csv, then refresh the sidecar
+  header = pd.read_csv(path, nrows=0).columns
+  names = [header[i] for i in columns]
+  sample = pd.read_csv(path, usecols=columns, dtype=float)[names]
+  if cache:
+    try:
+      temp = sidecar + ".tmp.npz"
+      np.savez(temp, mz=sample[names[0]].to_numpy(), rt=sample[names[1]].to_numpy(), i=sample[names[2]].to_numpy(),
+        names=np.array(names), columns=np.array(columns), stat=np.array([stat.st_size, stat.st_mtime_ns]))
+      os.replace(temp, sidecar)
+    except OSError:
+      pass
+  return sample
+
+# Publish named arrays in one shared memory block
+# Returns the block and the (name, dtype, shape, offset) layout workers attach with
+def shareArrays(arrays):
+  layout = []
+  size = 0
+  for name, array in arrays.items():
+    size = -(-size // 8) * 8
+    layout.append((name, array.dtype.str, array.shape, size))
+    size = size + array.nbytes
+  block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+  views = attachArrays(block, layout)
+  for name, array in arrays.items():
+    views[name][...] = array
+  return block, layout
+
+# View the arrays of a shared memory block in place, without copying
+def attachArrays(block, layout, writeable = True):
+  views = {}
+  for name, dtype, shape, offset in layout:
+    views[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+    views[name].flags.writeable = writeable
+  return views
+
+# Write the matches of one sample into its column of the shared result matrices
+# Result matrices are laid out samples x target rows so a column is contiguous
+# NOTE: if a target row has several matches only the first is kept
+def fillColumn(results, column, rowIndex, matches):
+  if len(matches) == 0:
+    return
+  matches = matches.reset_index(drop=True)
+  matches["match"] = range(0, len(matches))
+  hits = pd.merge(matches[["id","subid","match"]], rowIndex, on=["id","subid"]).drop_duplicates("row")
+  rows = hits.row.to_numpy()
+  match = hits.match.to_numpy()
+  results["intensities"][column, rows] = matches[matches.columns[4]].to_numpy(dtype=float)[match]
+  results["rtimes"][column, rows] = matches.rt.to_numpy(dtype=float)[match]
+  results["masscharges"][column, rows] = matches.mz.to_numpy(dtype=float)[match]
+
+# Digest of the content of an ADAP file
+def adapDigest(path):
+  digest = hashlib.blake2b(digest_size=20)
+  with open(path, "rb") as adap:
+    for chunk in iter(lambda: adap.read(1 << 20), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+# Key of one sample search result
+# Built from the ADAP file digest, the target index hash and the search parameters
+def searchKey(sampleDigest, targetDigest, parameters):
+  digest = hashlib.blake2b(digest_size=20)
+  digest.update(sampleDigest.encode())
+  digest.update(targetDigest.encode())
+  digest.update(repr(parameters).encode())
+  return digest.hexdigest()
+
+# Persist a sample search result as columns in an npz, written atomically
+def saveMatches(path, matches):
+  columns = matches.columns.tolist()
+  values = {}
+  for k, c in enumerate(columns):
+    values["c" + str(k)] = matches[c].to_numpy()
+    if values["c" + str(k)].dtype == object:
+      values["c" + str(k)] = values["c" + str(k)].astype(float)
+  temp = path + ".tmp.npz"
+  np.savez(temp, columns=np.array(columns), **values)
+  os.replace(temp, path)
+
+# Load a persisted sample search result, None if it is missing or unreadable
+def loadMatches(path):
+  if not os.path.isfile(path):
+    return None
+  try:
+    with np.load(path, allow_pickle=False) as stored:
+      columns = stored["columns"].tolist()
+      return pd.DataFrame({c: stored["c" + str(k)] for k, c in enumerate(columns)})[columns]
+  except (OSError, ValueError, KeyError):
+    return None
+
+# Attach a worker to one library
+# Targets are memory-mapped from the compiled target index, results are written to shared
+# memory (or to part-files when streaming) and the batch drift model is viewed in place
+def openLibrary(library):
+  index = openIndex(library["index"])
+  opened = dict(library)
+  opened["targets"] = pd.DataFrame({c: index[c] for c in indexColumns}, copy=False)
+  opened["mzIndex"] = (index["mzOrder"], index["mzLower"], index["mzUpper"], float(index["mzWidth"]))
+  opened["rowIndex"] = opened["targets"][["id","subid"]].copy()
+  opened["rowIndex"]["row"] = range(0, len(opened["targets"]))
+  if library["results"]:
+    opened["resultBlock"] = shared_memory.SharedMemory(name=library["results"][0])
+    opened["results"] = attachArrays(opened["resultBlock"], library["results"][1])
+  if library["batch"]:
+    opened["batchBlock"] = shared_memory.SharedMemory(name=library["batch"][0])
+    opened["batch"] = attachArrays(opened["batchBlock"], library["batch"][1])
+    opened["positions"] = library["batch"][2]
+    opened["driftTrts"] = np.linspace(opened["targets"].trt.min(), opened["targets"].trt.max(), driftGrid)
+  return opened
+
+# Search a sample against one library with the selected shift method
+# Stage times and counts of every pass are added to metrics when given
+def searchLibrary(library, sample, boundTestLimit, dtw, shift, trtSmallBound, dtwMethod, trtSeedBound, metrics = None):
+  targets = library["targets"]
+  mzIndex = library["mzIndex"]
+  # matches = targetSearch(targets, sample, 1)
+  # dtw scores are cached per sample and shared by the shift and final pass
+  # shifted bounds go to a shallow copy, the index arrays are read-only
+  dtwCache = {}
+  started = time.perf_counter()
+  if shift == "drift":
+    model = None
+    if library["batch"] and sample.columns[2] in library["positions"]:
+      seed = batchDrift(library["batch"]["driftCurves"], library["batch"]["driftBatches"], library["positions"][sample.columns[2]])
+      if seed is not None:
+        seeded = shiftWindows(targets.copy(deep=False), np.interp(targets.trt.to_numpy(dtype=float), library["driftTrts"], seed), trtSeedBound)
+        shifted, model = driftRt(seeded, sample, trtSeedBound, mzIndex)
+    if model is None:
+      shifted, model = driftRt(targets.copy(deep=False), sample, trtSmallBound, mzIndex)
+    addMetric(metrics, "shift", started)
+    return targetSearch(shifted, sample, boundTestLimit, dtw, dtwCache, dtwMethod, mzIndex, metrics)
+  elif shift == "median":
+    matches = targetSearch(targets, sample, boundTestLimit, dtw, dtwCache, dtwMethod, mzIndex, metrics)
+    started = time.perf_counter()
+    shifted, rtShift = shiftRt(targets.copy(deep=False), matches, trtSmallBound)
+    addMetric(metrics, "shift", started)
+    # print(adap + " " + str(rtShift))
+    return targetSearch(shifted, sample, boundTestLimit, dtw, dtwCache, dtwMethod, mzIndex, metrics)
+  return targetSearch(targets, sample, boundTestLimit, dtw, dtwCache, dtwMethod, mzIndex, metrics)
+
+# Read metabolic features
+# Extract mz time information with label
+# Search for targets and get best match, sample by sample
+# Each ADAP file is read once and searched against every library; a library is a dict of
+#   index        compiled target index directory
+#   results      (block name, layout) of its shared result matrices, None when streaming
+#   searchCache  (directory, target index hash, parameters), None without a search cache
+#   partdir      part-file directory when streaming, else None
+#   batch        (block name, layout, sample injection positions) of its batch drift model, or None
+#   name         library name, for the metrics
+# Only the sample column, its name and any part-files go back through the samples queue
+# With a search cache results are reused for unchanged ADAP files and only new or changed
+# ones are searched; with a batch model every finished sample publishes its drift curve
+# and drift searches of later samples start from the curve predicted by injection order
+# With a metrics directory each worker appends the stage times and counts of every sample
+# and library to its own worker.<pid>.jsonl, so workers never wait on each other;
+# samples named in profiles (ADAP file names without .csv) are run under cProfile
+# and their stats are dumped to <profiledir>/<sample>.prof
+def runSample(libraries, mzindex, rtindex, iindex, boundTestLimit, adapdir, ADAP, samples, lock, redundancy, dtw, shift, trtSmallBound, dtwMethod = "exact", adapCache = True, trtSeedBound = 0.15, metricsdir = None, profiledir = None, profiles = ()):
+  libraries = [openLibrary(library) for library in libraries]
+  metricsFile = open(metricsdir + "/worker." + str(os.getpid()) + ".jsonl", "a") if metricsdir else None
+  lock.acquire()
+  while not ADAP.empty():
+    column, adap = ADAP.get()
+    lock.release()
+    profiler = None
+    if profiledir and os.path.splitext(adap)[0] in profiles:
+      profiler = cProfile.Profile()
+      profiler.enable()
+    sample = None
+    digest = None
+    parts = []
+    for library in libraries:
+      metrics = {"sample": adap, "library": library["name"], "column": column, "worker": os.getpid()}
+      begun = started = time.perf_counter()
+      matches = None
+      if library["searchCache"]:
+        if digest is None:
+          digest = adapDigest(adapdir + "/" + adap)
+        cached = library["searchCache"][0] + "/" + searchKey(digest, library["searchCache"][1], library["searchCache"][2]) + ".npz"
+        matches = loadMatches(cached)
+        if matches is not None:
+          print(adap, " cached")
+        started = addMetric(metrics, "cacheRead", started)
+      metrics["cached"] = matches is not None
+      if matches is None:
+        if sample is None:
+          sample = readADAP(adapdir + "/" + adap, mzindex, rtindex, iindex, adapCache)
+          sample.columns = ["mz","rt"]+[sample.columns[2].replace(redundancy, "")]
+          started = addMetric(metrics, "read", started)
+        matches = searchLibrary(library, sample, boundTestLimit, dtw, shift, trtSmallBound, dtwMethod, trtSeedBound, metrics)
+        started = addMetric(metrics, "search", started)
+        if library["searchCache"]:
+          saveMatches(cached, matches)
+          started = addMetric(metrics, "cacheWrite", started)
+      # the sample name is the fifth match column
+      sampleId = matches.columns[4]
+      if library["batch"] and sampleId in library["positions"]:
+        model = matchDrift(matches)
+        if model is not None:
+          library["batch"]["driftCurves"][library["positions"][sampleId]] = np.interp(library["driftTrts"], model[0], model[1])
+      if library["partdir"]:
+        part = library["partdir"] + "/" + adap + ".npz"
+        saveMatches(part, matches)
+        parts.append(part)
+      else:
+        fillColumn(library["results"], column, library["rowIndex"], matches)
+      addMetric(metrics, "store", started)
+      if metricsFile:
+        # ru_maxrss is the peak resident set of the worker so far, in kilobytes on linux
+        metrics["total"] = time.perf_counter() - begun
+        metrics["peakRss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        metricsFile.write(json.dumps(metrics) + "\n")
+        metricsFile.flush()
+    if profiler:
+      profiler.disable()
+      profiler.dump_stats(profiledir + "/" + os.path.splitext(adap)[0] + ".prof")
+    samples.put((column, sampleId, parts))
+    lock.acquire()
+  lock.release()
+  if metricsFile:
+    metricsFile.close()
+  return
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "a:f:t:p:b:", ["dtw=", "no-adap-cache", "float32", "no-csv", "search-cache=", "no-search-cache", "stream", "shift=", "combined", "no-metrics", "profile="])
+  except getopt.GetoptError as err:
+    print(err)
+    sys.exit(2)
+  rawdir=None
+  adapdir=None
+  targetlists=[]
+  batchinfo=None
+  processors=1
+  dtwMethod="exact"
+  adapCache=True
+  storeDtype="float64"
+  csv=True
+  searchCacheDir=None
+  searchCaching=True
+  stream=False
+  shift="drift" # parameter for how we apply an automatic list shift, see shiftMethods
+  combined=False
+  keepMetrics=True
+  profiles=[]
+  print(opts)
+  for o, a in opts:
+    if o == "-a":
+      print(a)
+      adapdir = os.path.abspath(a)
+    elif o == "-f":
+      print(a)
+      featuredir = os.path.abspath(a)
+    elif o == "-t":
+      print(a)
+      targetlists += [os.path.abspath(t) for t in a.split(",") if t]
+    elif o == "-p":
+      print(a)
+      processors = int(a)
+    elif o == "-b":
+      print(a)
+      batchinfo = pd.read_csv(os.path.abspath(a), sep=",")
+    elif o == "--dtw":
+      print(a)
+      if a not in dtwMethods:
+        print("dtw method must be one of " + ", ".join(dtwMethods))
+        sys.exit(2)
+      dtwMethod = a
+    elif o == "--no-adap-cache":
+      adapCache = False
+    elif o == "--float32":
+      storeDtype = "float32"
+    elif o == "--no-csv":
+      csv = False
+    elif o == "--search-cache":
+      print(a)
+      searchCacheDir = os.path.abspath(a)
+    elif o == "--no-search-cache":
+      searchCaching = False
+    elif o == "--stream":
+      stream = True
+    elif o == "--shift":
+      print(a)
+      if a not in shiftMethods:
+        print("shift method must be one of " + ", ".join(shiftMethods))
+        sys.exit(2)
+      shift = a
+    elif o == "--combined":
+      combined = True
+    elif o == "--no-metrics":
+      keepMetrics = False
+    elif o == "--profile":
+      print(a)
+      profiles += [p for p in a.split(",") if p]
+    else:
+      print(o)
+      print(a)
+      print("unhandled option")
+      #sys.exit(2)
+  if not (adapdir and featuredir and targetlists):
+    print("missing options")
+    sys.exit(2)
+
+  # Get injection positions from the batch file: by batch, then by order in the file
+  positions = {}
+  if batchinfo is not None:
+    injections = batchinfo.reset_index(drop=True)
+    injections["injection"] = range(0, len(injections))
+    injections = injections.sort_values(["batch", "injection"], kind="stable")
+    positions = {str(s): p for p, s in enumerate(injections["sample"])}
+
+  # Get list of ADAP feature tables
+  # Each table is handed out with the result column it fills
+  # Tables named after batch samples go first, in injection order
+  adaps = Queue()
+  adaps = findADAP(adapdir, adaps, 0)
+  sampleNum = adaps.qsize()
+  adaps = [adaps.get() for column in range(0, sampleNum)]
+  ADAP = Queue()
+  for column in sorted(range(0, sampleNum), key = lambda c: positions.get(os.path.splitext(adaps[c])[0], len(positions))):
+    ADAP.put((column, adaps[column]))
+
+  # Set variables for reading file
+  # Indexes are for the sample files, not the target list
+  # NOTE: we need a good way to handle multiple target list formats
+  mzindex = 0
+  rtindex = 1
+  iindex = 3
+  redundancy = ".mzXML Peak area"
+
+  # Set variables for processing
+  boundTestLimit = 1 # this variable handles the number of times drtBound is optimized
+  trtBound = 0.3
+  trtSmallBound = 0.3
+  trtSeedBound = 0.15 # window around the batch drift prediction
+  # trt = "min" # apparently mzmine output is in minutes
+  dtw = True # parameter for whether we start with dtw
+
+  # Read each target list through its compiled index
+  # The index holds the deltappm and rt bounds and is only rebuilt when the list or trtBound change
+  # A list in a read-only directory keeps its index under the feature directory
+  # A single list writes to the feature directory as before, several lists (libraries)
+  # are searched in one pass over the ADAP tables and each writes to its own subdirectory
+  # if trt == "min":
+  #   targets.trt = targets.trt*60.0
+  libraries = []
+  for targetlist in targetlists:
+    library = {"name": os.path.splitext(os.path.basename(targetlist))[0]}
+    library["index"], library["hash"], library["targets"] = loadTargets(targetlist, trtBound, featuredir)
+    library["featuredir"] = featuredir if len(targetlists) == 1 else featuredir + "/" + library["name"]
+    os.makedirs(library["featuredir"], exist_ok=True)
+    libraries.append(library)
+  if len(set(library["name"] for library in libraries)) < len(libraries):
+    print("target lists must have distinct names")
+    sys.exit(2)
+
+  # Per-sample search results are cached by content, by default under the feature directory
+  # One cache serves every library, entries are keyed by the target index hash
+  parameters = None
+  if searchCaching:
+    if not searchCacheDir:
+      searchCacheDir = featuredir + "/search.cache"
+    os.makedirs(searchCacheDir, exist_ok=True)
+    parameters = (trtBound, trtSmallBound, drtMax, shift, dtw, dtwMethod, boundTestLimit, mzindex, rtindex, iindex, redundancy)
+    if positions and shift == "drift":
+      parameters = parameters + (trtSeedBound, driftGrid)
+
+  # Workers memory-map the target indexes
+  # Rows follow the target list and are located by (id, subid)
+  # Streaming: workers write part-files and are throttled by a bounded queue
+  # The collector merges each part into memory-mapped target rows x samples matrices
+  # in the feature store, viewed samples x target rows like the shared results
+  samples = Queue(2 * processors) if stream else Queue()
+
+  # Per-worker metrics of this run replace those of the previous one
+  # cProfile stats of the selected samples go next to them
+  metricsdir = None
+  profiledir = None
+  if keepMetrics:
+    metricsdir = featuredir + "/" + metricsName
+    os.makedirs(metricsdir, exist_ok=True)
+    for previous in os.listdir(metricsdir):
+      if previous.startswith("worker.") and previous.endswith(".jsonl"):
+        os.remove(metricsdir + "/" + previous)
+  if profiles:
+    profiledir = featuredir + "/" + metricsName + "/profiles"
+    os.makedirs(profiledir, exist_ok=True)
+  runStart = time.perf_counter()
+  try:
+    shares = []
+    for library in libraries:
+      targets = library["targets"]
+      library["featureFiles"] = {"intensities": library["featuredir"] + "/feature.sample.i.csv", "rtimes": library["featuredir"] + "/feature.sample.rt.csv", "masscharges": library["featuredir"] + "/feature.sample.mz.csv"}
+      library["resultBlock"] = None
+      library["batchBlock"] = None
+      share = {"index": library["index"], "results": None, "searchCache": None, "partdir": None, "batch": None, "name": library["name"]}
+      if searchCaching:
+        share["searchCache"] = (searchCacheDir, library["hash"], parameters)
+      if stream:
+        share["partdir"] = library["featuredir"] + "/parts"
+        os.makedirs(share["partdir"], exist_ok=True)
+        library["rowIndex"] = targets[["id","subid"]].copy()
+        library["rowIndex"]["row"] = range(0, len(targets))
+        library["stored"] = {k: openFeatures(path, len(targets), sampleNum, storeDtype) for k, path in library["featureFiles"].items()}
+        library["results"] = {k: values.T for k, values in library["stored"].items()}
+      else:
+        # Preallocate samples x target rows result matrices next to the targets
+        missing = np.full((sampleNum, len(targets)), np.nan)
+        library["resultBlock"], library["resultLayout"] = shareArrays({"intensities": missing, "rtimes": missing, "masscharges": missing})
+        share["results"] = (library["resultBlock"].name, library["resultLayout"])
+      if positions and shift == "drift":
+        # Batch drift model: one drift curve per injection, filled in as samples finish
+        library["batchBlock"], batchLayout = shareArrays({"driftCurves": np.full((len(injections), driftGrid), np.nan), "driftBatches": pd.factorize(injections["batch"])[0]})
+        share["batch"] = (library["batchBlock"].name, batchLayout, positions)
+      shares.append(share)
+
+    # Set up and end processes for running samples
+    compileKernels()
+    lock = Lock()
+    for p in range(0,processors):
+      worker = Process(target = runSample, args = (shares, mzindex, rtindex, iindex, boundTestLimit, adapdir, ADAP, samples, lock, redundancy, dtw, shift, trtSmallBound, dtwMethod, adapCache, trtSeedBound, metricsdir, profiledir, profiles), daemon = True)
+      worker.start()
+
+    # Workers fill their sample column in place and report its name
+    # or, when streaming, report the part-files to merge, one per library
+    sampleIds = [None] * sampleNum
+    for sampleNo in range(0, sampleNum):
+      column, sampleId, parts = samples.get()
+      sampleIds[column] = sampleId
+      for library, part in zip(libraries, parts):
+        fillColumn(library["results"], column, library["rowIndex"], loadMatches(part))
+
+    # Write each matrix once to the feature store, next to the target list columns
+    # Missing values are written as 0
+    searchEnd = time.perf_counter()
+    for library in libraries:
+      if stream:
+        for k, path in library["featureFiles"].items():
+          closeFeatures(path, library["targets"], library["stored"][k], sampleIds, csv)
+        del library["results"], library["stored"]
+      else:
+        results = attachArrays(library["resultBlock"], library["resultLayout"], False)
+        for k, path in library["featureFiles"].items():
+          writeFeatures(path, library["targets"], np.nan_to_num(results[k].T, nan=0), sampleIds, storeDtype, csv)
+        del results
+
+    # Combined tables of all libraries, in the layout of combineLib.py
+    if combined and len(libraries) > 1:
+      for k, fileType in [("intensities", "sample.i"), ("rtimes", "sample.rt"), ("masscharges", "sample.mz")]:
+        tables = []
+        for library in libraries:
+          rows, values = readFeatures(library["featureFiles"][k])
+          table = pd.concat([rows, values], axis=1).reset_index().rename(columns={"index": "Unnamed: 0"})
+          table.insert(0, "lib", library["name"])
+          tables.append(table)
+        tables = pd.concat(tables)
+        tables.sort_values(by = ["lib", "id", "subid"], inplace = True)
+        tables.to_csv(featuredir + "/lib." + fileType + ".csv", index = False)
+
+    # Run settings and the wall time of the search and the writes, for metricsReport.py
+    if metricsdir:
+      with open(metricsdir + "/run.json", "w") as run:
+        json.dump({"samples": sampleNum, "processors": processors, "libraries": [library["name"] for library in libraries],
+          "shift": shift, "dtw": dtwMethod, "stream": stream, "searchCache": searchCaching,
+          "search": searchEnd - runStart, "write": time.perf_counter() - searchEnd}, run)
+  finally:
+    for library in libraries:
+      if library.get("resultBlock"):
+        library["resultBlock"].unlink()
+      if library.get("batchBlock"):
+        library["batchBlock"].unlink()
+
+if __name__ == "__main__":
+  main()
@@ -4,6 +4,7 @@
 import sys
 import os
 import getopt
+import hashlib
 
 from multiprocessing import Process, Queue, Lock
 
@@ -13,11 +14,73 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import warnings
 warnings.filterwarnings('ignore')
-from sklearn.linear_model import LinearRegression
+
+# feature store shared with GCCombo and GCSummary
+from featureStore import readFeatures, writeFeatures
+
+# Sum the rows of values (samples x fragments) into groups, in row order
+def groupSum(values, codes, groupCount):
+  sums = np.zeros((groupCount,) + values.shape[1:])
+  np.add.at(sums, codes, values)
+  return sums
+
+# Fit a no-intercept curve per group and fragment, for all of them at once
+# intensities are dilutions x fragments, concentrations and codes (the group of each
+# dilution) follow the dilutions
+# Only dilutions with a positive intensity take part in the fit of a fragment
+# beta is the least squares slope sum(x*y)/sum(x*x) of concentration on intensity
+# rsquared follows sklearn's score: nan below two points and, for a constant
+# concentration, 1 on a perfect fit and 0 otherwise
+# Returns dsamp, dconc, beta and rsquared, each groups x fragments
+def fitCurves(intensities, concentrations, codes, groupCount):
+  concentrations = concentrations[:, None]
+  fitted = intensities > 0
+  x = np.where(fitted, intensities, 0.0)
+  y = np.where(fitted, concentrations, 0.0)
+  dsamp = groupSum(fitted, codes, groupCount).astype(int)
+  dconc = np.zeros(dsamp.shape, dtype=int)
+  for c in np.unique(concentrations):
+    dconc += groupSum(fitted & (concentrations == c), codes, groupCount) > 0
+  with np.errstate(divide="ignore", invalid="ignore"):
+    beta = np.where(dsamp > 0, groupSum(x*y, codes, groupCount) / groupSum(x*x, codes, groupCount), np.nan)
+    residual = groupSum(np.where(fitted, (y - x*beta[codes])**2, 0.0), codes, groupCount)
+    mean = groupSum(y, codes, groupCount) / dsamp
+    spread = groupSum(np.where(fitted, (y - mean[codes])**2, 0.0), codes, groupCount)
+    rsquared = np.where(spread != 0, 1 - residual/spread, np.where(residual == 0, 1.0, 0.0))
+  rsquared[dsamp < 2] = np.nan
+  return (dsamp, dconc, beta, rsquared)
+
+# Hash of every standard: its name, dilution, batch and intensities
+def standardHashes(standards, intensities):
+  hashes = []
+  for row in standards.itertuples(index=False):
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((str(row.sample), float(row.dilu), str(getattr(row, "batch", "")))).encode())
+    digest.update(intensities[row.sample].to_numpy(dtype=float).tobytes())
+    hashes.append(digest.hexdigest())
+  return hashes
+
+# Calibration model file
+# Keeps the library, the standards and their hashes, the fragments (id, subid) and
+# the curves across all standards (dsamp, dconc, beta, rsquared, one row each);
+# by batch also the batches and their curves (batchDsamp, ..., one row per batch)
+# Text columns are stored as strings so the file loads without pickle
+def saveModel(path, model):
+  arrays = {k: np.asarray(v) for k, v in model.items()}
+  temp = path + ".tmp.npz"
+  np.savez(temp, **{k: v.astype(str) if v.dtype == object else v for k, v in arrays.items()})
+  os.replace(temp, path)
+
+def loadModel(path):
+  with np.load(path, allow_pickle=False) as stored:
+    model = {k: stored[k] for k in stored.files}
+  model["stdlib"] = str(model["stdlib"])
+  model["byBatch"] = bool(model["byBatch"])
+  return model
 
 # get input options
 try:
-  opts, args = getopt.getopt(sys.argv[1:], "i:d:s:q:")
+  opts, args = getopt.getopt(sys.argv[1:], "i:d:s:q:m:", ["float32", "no-csv", "by-batch", "apply"])
 except getopt.GetoptError as err:
   print(err)
   sys.exit(2)
@@ -25,68 +88,110 @@ intensities = None
 dilutions = None
 stdlib = None
 quantifications = None
+storeDtype = "float64"
+csv = True
+byBatch = False
+modelPath = None
+apply = False
 for o, a in opts:
   if o == "-i":
     print(a)
-    intensities = pd.read_csv(os.path.abspath(a), sep=",")
+    intensityRows, intensities = readFeatures(a)
   if o == "-d":
     dilutions = pd.read_csv(os.path.abspath(a), sep=",")
   if o == "-s":
     stdlib = a
   if o == "-q":
     quantifications = os.path.abspath(a)
+  if o == "--float32":
+    storeDtype = "float32"
+  if o == "--no-csv":
+    csv = False
+  if o == "--by-batch":
+    byBatch = True
+  if o == "-m":
+    modelPath = os.path.abspath(a)
+  if o == "--apply":
+    apply = True
+
 
+# Calibration model from an earlier run, see saveModel
+# --apply quantifies the subjects with it as is, without the standards
+# Otherwise it is reused when it was fitted on the same library, fragments and
+# standards (by hash) in the same mode, and refitted and saved when not
+model = None
+if modelPath and os.path.exists(modelPath):
+  model = loadModel(modelPath)
+  if not (np.array_equal(model["ids"], intensityRows["id"].to_numpy()) and np.array_equal(model["subids"], intensityRows["subid"].to_numpy())):
+    print("calibration model fragments do not match " + modelPath)
+    if apply:
+      sys.exit(2)
+    model = None
+if apply:
+  if model is None:
+    print("missing calibration model")
+    sys.exit(2)
+  byBatch = model["byBatch"]
 
-# set up transposed dataframe for looping regression
+# set up dilution and subject matrices, samples x fragments
 subjects = dilutions["sample"][(dilutions.type == "subject")].sort_values().tolist()
+subjectBatches = dilutions.set_index("sample").loc[subjects, "batch"].to_numpy() if byBatch else None
 dilutions = dilutions[(dilutions["type"] == stdlib)].sort_values(["dilu", "sample"])
-dilutionIntensities = intensities[dilutions["sample"].tolist()].transpose()
-concentrations = dilutions.dilu.tolist()
-sampleIntensities = intensities[subjects].transpose()
-sampleIntensities.columns = dilutionIntensities.columns
+sampleIntensities = intensities[subjects].to_numpy(dtype=float).T
 
 # added to handle lists where concentrations are handled
 # on a target by target basis
-concentrationModifiers = intensities["concentration"].tolist()
-
-dsamp = list()
-dconc = list()
-beta = list()
-rsquared = list()
-ii = 0
-for i in dilutionIntensities:
-  fragment = dilutionIntensities[[i]]
-  fragment["concentration"] = concentrations
-  fragment = fragment[(fragment[i] > 0)]
-  dsamp.append(len(fragment.index))
-  dconc.append(len(fragment.concentration.unique()))
-  if len(fragment.index) > 0:
-    x = np.array(fragment[i]).reshape(-1, 1)
-    y = np.array(fragment.concentration).reshape(-1, 1)
-    curve = LinearRegression(fit_intercept = False).fit(x, y)
-    curveBeta = curve.coef_.item(0)
-    beta.append(curveBeta)
-    rsquared.append(curve.score(x, y))
-
-    for j in sampleIntensities.index:
-      sampleIntensities.at[j, i] = curveBeta * sampleIntensities.at[j, i] * concentrationModifiers[ii]
+concentrationModifiers = intensityRows["concentration"].to_numpy(dtype=float)
 
+if not apply:
+  hashes = standardHashes(dilutions, intensities)
+  if model is not None and (model["stdlib"], model["byBatch"], model["standardHashes"].tolist()) == (stdlib, byBatch, hashes):
+    print("calibration model is current")
   else:
-    beta.append(np.nan)
-    rsquared.append(np.nan)
-
-    for j in sampleIntensities.index:
-      sampleIntensities.at[j, i] = np.nan
-  ii = ii + 1
-
-sampleIntensities = sampleIntensities.transpose()
-quant = intensities.iloc[:,1:14]
-quant["dsamp"] = dsamp
-quant["dconc"] = dconc
-quant["beta"] = beta
-quant["rsquared"] = rsquared
-
-quant = pd.concat([quant, sampleIntensities], axis = 1)
-quant.to_csv(quantifications)
+    # Fit one curve per fragment across all dilutions
+    # By batch, every batch gets its own curves, fitted in the same pass
+    dilutionIntensities = intensities[dilutions["sample"].tolist()].to_numpy(dtype=float).T
+    concentrations = dilutions.dilu.to_numpy(dtype=float)
+    model = {"stdlib": stdlib, "byBatch": byBatch, "standards": dilutions["sample"].astype(str).to_numpy(), "standardHashes": hashes,
+      "ids": intensityRows["id"].to_numpy(), "subids": intensityRows["subid"].to_numpy()}
+    for k, values in zip(["dsamp", "dconc", "beta", "rsquared"], fitCurves(dilutionIntensities, concentrations, np.zeros(len(concentrations), dtype=int), 1)):
+      model[k] = values
+    if byBatch:
+      batches, batchCodes = np.unique(np.concatenate([dilutions["batch"].to_numpy(), subjectBatches]), return_inverse=True)
+      model["batches"] = batches.astype(str)
+      for k, values in zip(["batchDsamp", "batchDconc", "batchBeta", "batchRsquared"], fitCurves(dilutionIntensities, concentrations, batchCodes[:len(dilutions)], len(batches))):
+        model[k] = values
+    if modelPath:
+      saveModel(modelPath, model)
+
+# Apply the curves to the subject intensities
+# Fragments without a curve are nan
+# By batch, subjects are quantified with the curves of their batch; subjects of a
+# batch without dilutions, or not in the model, are nan
+# The quantification table keeps the curves across all batches, the batch curves
+# go to <quantifications>.batch.csv, one line per fragment and batch
+if byBatch:
+  batches = model["batches"]
+  batchCodes = pd.Series(range(0, len(batches)), index=batches).reindex(subjectBatches.astype(str)).fillna(len(batches)).to_numpy(dtype=int)
+  batchBeta = np.vstack([model["batchBeta"], np.full((1, len(intensityRows)), np.nan)])
+  sampleIntensities = (sampleIntensities * batchBeta[batchCodes] * concentrationModifiers).T
+  batchCurves = pd.DataFrame({
+    "id": np.tile(intensityRows["id"].to_numpy(), len(batches)),
+    "subid": np.tile(intensityRows["subid"].to_numpy(), len(batches)),
+    "batch": np.repeat(batches, len(intensityRows))
+    })
+  for k in ["dsamp", "dconc", "beta", "rsquared"]:
+    batchCurves[k] = model["batch" + k.capitalize()].ravel()
+  batchCurves.to_csv(os.path.splitext(quantifications)[0] + ".batch.csv", index=False)
+else:
+  sampleIntensities = (sampleIntensities * model["beta"][0] * concentrationModifiers).T
+
+quant = intensityRows.copy()
+quant["dsamp"] = model["dsamp"][0]
+quant["dconc"] = model["dconc"][0]
+quant["beta"] = model["beta"][0]
+quant["rsquared"] = model["rsquared"][0]
+
+writeFeatures(quantifications, quant, sampleIntensities, subjects, storeDtype, csv)
 
 
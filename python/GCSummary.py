@@ -9,299 +9,596 @@ from multiprocessing import Process, Queue, Lock
 
 # data libraries
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
 import warnings
 warnings.filterwarnings('ignore')
 
-# get input options
-try:
-  opts, args = getopt.getopt(sys.argv[1:], "f:i:r:m:q:n:b:l:s:c:xh", ["quant"])
-except getopt.GetoptError as err:
-  print(err)
-  sys.exit(2)
-# required parameters
-featuresLoc = ""
-intensitiesLoc = "feature.sample.i.csv"
-rtimesLoc = "feature.sample.rt.csv"
-masschargesLoc = "feature.sample.mz.csv"
-quantsLoc = "feature.sample.quant.csv"
-summaryname = [
-  "feature.sample.summary.csv","feature.subject.summary.csv",
-  "feature.sample.qsummary.csv","feature.subject.qsummary.csv"
-  ] # summary file naming options based on input
-defaultnameToggle = True
-# additional parameters
-batchinfo = None # batch file
-labels = ["subject"] # sample type filter
-stdlib = None # standards library
-repToggle = False # toggles replicate summarization
-quantToggle = False # toggles quantification options
-corrToggle = False
-detectMin = sys.float_info.min
-for o, a in opts:
-  if o == "-h":
-    print("PeakWalk: Automated GC Identification and Quantification")
-    print("-f feature files location, optional")
-    print("  default feature files location is working directory")
-    print("  sets location for input and output")
-    print("-i intensity file, optional")
-    print("-r retention time file, optional")
-    print("-m masscharge file, optional")
-    print("  -irm are optional, but feature files are required, see -f")
-    print("  default file names are feature.sample.{i, mz, rt}.csv")
-    print("-q quantification file, optional, requires -b")
-    print("  overrides intensity with concentration")
-    print("-n summary file name, optional")
-    print("-b batch file, optional")
-    print("-l filter labels, optional, comma-separated, requires -b")
-    print("-s standards library, optional, function not implemented")
-    print("-x toggle replicate summarization, optional, requires -b")
-    print("-c sets correlation filter, optional")
-    print("-h help, optional")
-    sys.exit()
-  if o == "-f":
-    featuresLoc = a + "/"
-  if o == "-i":
-    print(a)
-    intensitiesLoc = a
-  if o == "-r":
-    rtimesLoc = a
-  if o == "-m":
-    masschargesLoc = a
-  if o == "-q":
-    quantToggle = True
-    quantsLoc = a
-  if o == "--quant":
-    quantToggle = True
-  if o == "-n":
-    defaultnameToggle = False
-    summaryname = a
-  if o == "-b":
-    batchinfo = pd.read_csv(os.path.abspath(a), sep=",")
-  if o == "-l":
-    labels = a.split(",")
-  if o == "-s":
-    stdlib = a
-  if o == "-x":
-    repToggle = True
-  if o == "-c":
-    corrToggle = True
-    corrMin = float(a)
-
-# read in data based on input
-intensities = pd.read_csv(os.path.abspath(featuresLoc + intensitiesLoc), sep=",")
-rtimes = pd.read_csv(os.path.abspath(featuresLoc + rtimesLoc), sep=",")
-masscharges = pd.read_csv(os.path.abspath(featuresLoc + masschargesLoc), sep=",")
-quants = None
-if quantToggle:
-  quants = pd.read_csv(os.path.abspath(featuresLoc + quantsLoc), sep=",")
-if defaultnameToggle:
-  if quantToggle:
-    if repToggle:
-      summaryname = summaryname[3]
-    else:
-      summaryname = summaryname[2]
-  else:
-    if repToggle:
-      summaryname = summaryname[1]
-    else:
-      summaryname = summaryname[0]
-summaryname = featuresLoc + summaryname
-
-# get list of samples based on input
-samples = []
-sources = []
-libsamples = []
-libsources = []
-if batchinfo is not None and labels:
-  # get samples and sources for selected sample types
-  for label in labels:
-    samples = samples + batchinfo[batchinfo["type"] == label]["sample"].tolist()
-    if repToggle:
+# feature store shared with GCCombo and GCQuant
+from featureStore import readFeatures, mapFeatures
+
+# default input and output file names
+intensitiesName = "feature.sample.i.csv"
+rtimesName = "feature.sample.rt.csv"
+masschargesName = "feature.sample.mz.csv"
+quantsName = "feature.sample.quant.csv"
+
+# Summary variants are named after the summary file they write, feature.<variant>.csv
+#   <level>.<kind>[.corr]
+#   level  sample (every sample) or subject (replicate medians per source id)
+#   kind   summary (intensities) or qsummary (concentrations)
+#   corr   with the correlation filter
+variantLevels = ["sample", "subject"]
+variantKinds = ["summary", "qsummary"]
+
+# Parse a variant name into (replicates, quant, corr) toggles
+def parseVariant(variant):
+  parts = variant.split(".")
+  if len(parts) not in [2, 3] or parts[0] not in variantLevels or parts[1] not in variantKinds or parts[2:] not in [[], ["corr"]]:
+    raise ValueError("unknown summary variant: " + variant)
+  return (parts[0] == "subject", parts[1] == "qsummary", len(parts) == 3)
+
+# Name of the variant with the given toggles
+def variantName(repToggle, quantToggle, corrToggle):
+  return variantLevels[repToggle] + "." + variantKinds[quantToggle] + (".corr" if corrToggle else "")
+
+# Read the feature tables of a summary
+# Each feature table comes back as target rows and a samples-only value table
+# mapped keeps every value table memory-mapped, CSV exports included (see mapFeatures)
+def readInputs(featuresLoc = "", intensitiesLoc = intensitiesName, rtimesLoc = rtimesName, masschargesLoc = masschargesName, quantsLoc = None, mapped = False):
+  reader = mapFeatures if mapped else readFeatures
+  inputs = {
+    "intensities": reader(featuresLoc + intensitiesLoc),
+    "rtimes": reader(featuresLoc + rtimesLoc),
+    "masscharges": reader(featuresLoc + masschargesLoc)
+    }
+  if quantsLoc:
+    inputs["quants"] = reader(featuresLoc + quantsLoc)
+  return inputs
+
+# Get list of samples based on input
+# Returns the samples and source ids of the selected sample types and of the standards library
+def selectSamples(intensities, batchinfo = None, labels = ["subject"], stdlib = None):
+  samples = []
+  sources = []
+  libsamples = []
+  libsources = []
+  if batchinfo is not None and labels:
+    # get samples and sources for selected sample types
+    for label in labels:
+      samples = samples + batchinfo[batchinfo["type"] == label]["sample"].tolist()
       sources = sources + batchinfo[batchinfo["type"] == label]["id"].unique().tolist()
-  # get samples and sources for standard library
-  if stdlib:
-    libsamples = batchinfo[batchinfo["type"] == stdlib]["sample"].tolist()
-    if repToggle:
+    # get samples and sources for standard library
+    if stdlib:
+      libsamples = batchinfo[batchinfo["type"] == stdlib]["sample"].tolist()
       libsources = batchinfo[batchinfo["type"] == stdlib]["id"].unique().tolist()
-else:
-  samples = intensities.columns[14:].tolist()
-  samples.sort()
-
-# create initial fragment summaries
-summaries = masscharges[["tmz", "trt", "id", "subid", "name", "monoisotopic", "cas", "formula"]]
-
-# summarize rtimes
-rtimes = rtimes[samples]
-rtimes[rtimes == 0] = np.nan
-if repToggle:
-  # get medians for replicates
-  replicates = pd.DataFrame()
-  for source in sources:
-    replicates[source] = rtimes[batchinfo[batchinfo["id"] == source]["sample"].tolist()].median(axis=1)
-  rtimes = replicates
-summaries["rtMed"] = rtimes.median(axis=1)
-summaries["rtMin"] = rtimes.min(axis=1)
-summaries["rtMax"] = rtimes.max(axis=1)
-summaries["rtRange"] = summaries["rtMax"].sub(summaries["rtMin"])
-
-# summarize masses
-masscharges = masscharges[samples]
-masscharges[masscharges == 0] = np.nan
-if repToggle:
-  # get medians for replicates
-  replicates = pd.DataFrame()
-  for source in sources:
-    replicates[source] = masscharges[batchinfo[batchinfo["id"] == source]["sample"]].median(axis=1)
-  masscharges = replicates
-summaries["mzMed"] = masscharges.median(axis=1)
-summaries["mzMin"] = masscharges.min(axis=1)
-summaries["mzMax"] = masscharges.max(axis=1)
-summaries["mzRange"] = summaries["mzMax"].sub(summaries["mzMin"])
-
-# summarize standards if library provided
-if libsamples:
-  libintensities = intensities[libsamples]
-  libintensities[libintensities == 0] = np.nan
+  else:
+    samples = intensities.columns.tolist()
+    samples.sort()
+  return (samples, sources, libsamples, libsources)
+
+# Select sample columns and mark non-detections (0) as missing
+def sampleValues(values, samples):
+  values = values[samples]
+  values[values == 0] = np.nan
+  return values
+
+# Pad groups of positions into a groups x members table
+# codes holds the group of every position (-1 for none), members keep their order and
+# the table is padded with -1
+def groupSlots(codes, groupCount):
+  positions = np.flatnonzero(codes >= 0)
+  positions = positions[np.argsort(codes[positions], kind="stable")]
+  counts = np.bincount(codes[positions], minlength=groupCount)
+  members = np.arange(len(positions)) - np.repeat(np.cumsum(counts) - counts, counts)
+  slots = np.full((groupCount, counts.max(initial=0)), -1)
+  slots[codes[positions], members] = positions
+  return slots
+
+# Index of the rows of every id, built once and shared by the per-id passes
+# Returns (codes, order, starts): the id number of every row, the rows sorted by id
+# (rows of an id keep their order) and where the rows of each id start in order,
+# with the row count as the last start
+def idIndex(ids):
+  codes = pd.factorize(ids)[0]
+  order = np.argsort(codes, kind="stable")
+  starts = np.searchsorted(codes[order], np.arange(codes.max(initial=-1) + 2))
+  return (codes, order, starts)
+
+# Per-id reduction of row values with a ufunc (np.add, np.maximum, ...)
+# values has a row per fragment, the result a row per id
+def idReduce(ufunc, values, index):
+  codes, order, starts = index
+  if len(order) == 0:
+    return values[:0]
+  return ufunc.reduceat(values[order], starts[:-1], axis=0)
+
+# Get medians for replicates
+# Every sample column is mapped to its source id through the batch file and the
+# medians of all matrices (fragments x samples, same samples) are taken in one pass:
+# the columns are stacked and padded into matrices x fragments x sources x replicates
+# Missing values are skipped, a source without any value is missing
+# Returns a fragments x sources table per matrix
+def replicateMedians(matrices, samples, sources, batchinfo):
+  sampleSources = batchinfo.drop_duplicates("sample").set_index("sample")["id"].reindex(samples)
+  slots = groupSlots(pd.Index(sources).get_indexer(sampleSources), len(sources))
+  stacked = np.stack([matrix.to_numpy(dtype=float) for matrix in matrices])
+  padded = np.where(slots >= 0, stacked[:, :, slots], np.nan)
+  # the median is taken from the sorted replicates, missing values sort last
+  padded.sort(axis=3)
+  valid = (~np.isnan(padded)).sum(axis=3, keepdims=True)
+  lower = np.take_along_axis(padded, np.maximum(valid - 1, 0) // 2, axis=3)
+  upper = np.take_along_axis(padded, valid // 2 - (valid == 0), axis=3) if padded.shape[3] > 0 else lower
+  medians = np.where(valid > 0, (lower + upper) / 2, np.nan)[:, :, :, 0]
+  return [pd.DataFrame(median, index=matrix.index, columns=sources) for matrix, median in zip(matrices, medians)]
+
+# Sample values of several matrices, replicate medians when repToggle
+def subjectValues(matrices, samples, sources, batchinfo, repToggle):
+  matrices = [sampleValues(matrix, samples) for matrix in matrices]
   if repToggle:
-    replicates = pd.DataFrame()
-    for source in libsources:
-      replicates[source] = libintensities[batchinfo[batchinfo["id"] == source]["sample"]].median(axis=1)
-    libintensities = replicates
+    matrices = replicateMedians(matrices, samples, sources, batchinfo)
+  return matrices
+
+# Median, min, max and range of each fragment
+def rangeSummary(values, prefix):
+  summary = pd.DataFrame(index=values.index)
+  summary[prefix + "Med"] = values.median(axis=1)
+  summary[prefix + "Min"] = values.min(axis=1)
+  summary[prefix + "Max"] = values.max(axis=1)
+  summary[prefix + "Range"] = summary[prefix + "Max"].sub(summary[prefix + "Min"])
+  return summary
+
+# Detection and quality of each fragment in the standards
+# index is the id index of the summaries, see idIndex
+def librarySummary(summaries, libintensities, index):
+  summaries = summaries[["id"]].copy()
+  codes = index[0]
   # basic info on detection in the standard
   summaries["libDetectCnt"] = libintensities.count(axis=1)
   summaries["libDetectFrac"] = summaries["libDetectCnt"].div(len(libintensities.columns))
   # more complex info about quality in the standard
-  ids = summaries[(summaries["libDetectCnt"] > 0)]["id"].drop_duplicates()
-  summaries["libFragCnt"] = 0
-  summaries["libQualityCnt"] = 0
-  for i in ids:
-    # get the number of detected fragments per id in std
-    # get number of quality detections per id in std
-    #   a quality detection is defined as 3 detected fragments in one sample
-    frags = summaries.index[(summaries["id"] == i) & (summaries["libDetectCnt"] > 0)].tolist()
-    summaries.loc[frags, "libFragCnt"] = len(frags)
-    simulCnt = libintensities.loc[frags].count(axis=0)
-    summaries.loc[frags, "libQualityCnt"] = (simulCnt >= 3).sum()
+  # get the number of detected fragments per id in std
+  # get number of quality detections per id in std
+  #   a quality detection is defined as 3 detected fragments in one sample
+  detected = (summaries["libDetectCnt"] > 0).to_numpy()
+  simulCnt = idReduce(np.add, libintensities.loc[summaries.index].notna().to_numpy(dtype=int), index)
+  summaries["libFragCnt"] = np.where(detected, idReduce(np.add, detected.astype(int), index)[codes], 0)
+  summaries["libQualityCnt"] = np.where(detected, (simulCnt >= 3).sum(axis=1)[codes], 0)
   summaries["libQualityFrac"] = summaries["libQualityCnt"].div(len(libintensities.columns))
+  return summaries.drop(columns="id")
+
+# Intensity statistics and detection of each fragment
+# The rows are copied C ordered first, the row sums of the mean then run in the same
+# order whether the frame is a whole table or a block of one, see summarizeBlocks
+def intensitySummary(intensities):
+  summary = pd.DataFrame(index=intensities.index)
+  intensities = pd.DataFrame(np.ascontiguousarray(intensities.to_numpy()), index=intensities.index, columns=intensities.columns)
+  summary["iMean"] = intensities.mean(axis=1)
+  summary["iStd"] = intensities.std(axis=1)
+  summary["iCV"] = summary["iStd"].div(summary["iMean"])
+  summary["detectCnt"] = intensities.count(axis=1)
+  summary["detectFrac"] = summary["detectCnt"].div(len(intensities.columns))
+  return summary
+
+# Pearson correlations of pairs of value rows, NaN-aware like DataFrame.corr
+# values holds a row per fragment and a column per sample, x and y the rows of each pair
+# Every pair takes the running means and sums of squares DataFrame.corr uses, one
+# sample at a time, so the correlations are the same to the last bit
+# Pairs with less than two shared detections or without variance are missing
+def pairCorrelations(values, x, y):
+  nobs = np.zeros(len(x))
+  meanx = np.zeros(len(x))
+  meany = np.zeros(len(x))
+  ssqdmx = np.zeros(len(x))
+  ssqdmy = np.zeros(len(x))
+  covxy = np.zeros(len(x))
+  for sample in np.ascontiguousarray(values.T):
+    vx = sample[x]
+    vy = sample[y]
+    shared = ~(np.isnan(vx) | np.isnan(vy))
+    nobs += shared
+    dx = vx - meanx
+    dy = vy - meany
+    meanx = np.where(shared, meanx + 1. / nobs * dx, meanx)
+    meany = np.where(shared, meany + 1. / nobs * dy, meany)
+    ssqdmx = np.where(shared, ssqdmx + (vx - meanx) * dx, ssqdmx)
+    ssqdmy = np.where(shared, ssqdmy + (vy - meany) * dy, ssqdmy)
+    covxy = np.where(shared, covxy + (vx - meanx) * dy, covxy)
+  divisor = np.sqrt(ssqdmx * ssqdmy)
+  return np.where((nobs > 0) & (divisor != 0), covxy / divisor, np.nan)
 
-# summarize intensities
-intensities = intensities[samples]
-intensities[intensities == 0] = np.nan
-if repToggle:
-  # get medians for replicates
-  replicates = pd.DataFrame()
-  for source in sources:
-    replicates[source] = intensities[batchinfo[batchinfo["id"] == source]["sample"]].median(axis=1)
-  intensities = replicates
-summaries["iMean"] = intensities.mean(axis=1)
-summaries["iStd"] = intensities.std(axis=1)
-summaries["iCV"] = summaries["iStd"].div(summaries["iMean"])
-summaries["detectCnt"] = intensities.count(axis=1)
-summaries["detectFrac"] = summaries["detectCnt"].div(len(intensities.columns))
-
-# quality-based filtering
-summaries["badFlag"] = 0
-summaries.loc[(summaries["detectFrac"] < detectMin), "badFlag"] = 1
-# optional correlation-based filtering
-if corrToggle:
+# Correlation filter of a block of ids
+# slots holds the value rows of each id's fragments (ids x fragments, padded with -1)
+# Fragments without any correlation are dropped, then the fragment with the lowest mean
+# correlation to the others is dropped until all are at least corrMin; the ids are
+# handled together, one fragment per id and round
+# Returns the bad flags and mean correlations of the slots, ids left with less than two
+# fragments are bad
+def correlationFilter(values, slots, corrMin):
+  groups = np.arange(len(slots))
+  width = slots.shape[1]
+  active = slots >= 0
+  bad = np.zeros(slots.shape, dtype=bool)
+  corrMean = np.zeros(slots.shape)
+  # correlations of every fragment pair of an id, the later fragment is x as in DataFrame.corr
+  first, second = np.triu_indices(width, 1)
+  pairs = np.nonzero(active[:, first] & active[:, second])
+  fragCorr = np.full((len(slots), width, width), np.nan)
+  pairCorr = pairCorrelations(values, slots[pairs[0], second[pairs[1]]], slots[pairs[0], first[pairs[1]]])
+  fragCorr[pairs[0], first[pairs[1]], second[pairs[1]]] = pairCorr
+  fragCorr[pairs[0], second[pairs[1]], first[pairs[1]]] = pairCorr
+  fragCnt = active.sum(axis=1)
+  noOverlap = active & np.isnan(fragCorr).all(axis=2) & (fragCnt > 1)[:, None]
+  bad |= noOverlap
+  active &= ~noOverlap
+  fragCnt = active.sum(axis=1)
+  running = fragCnt > 1
+  while running.any():
+    # ids with the same number of remaining fragments are handled as one stack
+    for count in np.unique(fragCnt[running]):
+      ids = groups[running & (fragCnt == count)]
+      # remaining fragments in order, as left by deleting the dropped ones; means are
+      # summed along the contiguous axis like np.nanmean on the column-ordered per-id matrix
+      frags = np.argsort(~active[ids], axis=1, kind="stable")[:, :count]
+      meanCorr = np.nanmean(fragCorr[ids[:, None, None], frags[:, :, None], frags[:, None, :]], axis=2)
+      worstFrag = np.argmin(meanCorr, axis=1)
+      drop = meanCorr[np.arange(len(ids)), worstFrag] < corrMin
+      corrMean[ids[~drop, None], frags[~drop]] = meanCorr[~drop]
+      running[ids[~drop]] = False
+      dropped = ids[drop]
+      worstFrag = frags[drop, worstFrag[drop]]
+      active[dropped, worstFrag] = False
+      bad[dropped, worstFrag] = True
+      fragCnt[dropped] -= 1
+      running[dropped] = fragCnt[dropped] > 1
+  bad |= active & (fragCnt <= 1)[:, None]
+  return (bad, corrMean)
+
+# Correlation filter of part of the ids, run in its own process
+def correlationWorker(values, slots, corrMin, part, results):
+  results.put((part, correlationFilter(values, slots, corrMin)))
+
+# Run the correlation filter with the ids split over several processes
+# Every process gets the value rows of its own ids
+def parallelCorrelationFilter(values, slots, corrMin, processors = 1):
+  parts = [part for part in np.array_split(slots, max(processors, 1)) if len(part) > 0]
+  if len(parts) <= 1 or slots.shape[1] == 0:
+    return correlationFilter(values, slots, corrMin)
+  results = Queue()
+  workers = []
+  for p, part in enumerate(parts):
+    rows, local = np.unique(part, return_inverse=True)
+    local = np.where(part >= 0, local.reshape(part.shape) - int((rows < 0).any()), -1)
+    worker = Process(target = correlationWorker, args = (values[rows[rows >= 0]], local, corrMin, p, results), daemon = True)
+    worker.start()
+    workers.append(worker)
+  filtered = dict(results.get() for worker in workers)
+  for worker in workers:
+    worker.join()
+  return tuple(np.concatenate([filtered[p][k] for p in range(0, len(parts))]) for k in range(0, 2))
+
+# Quality-based filtering, and the optional correlation-based filtering
+# Returns badFlag, and corrMean when filtering on correlation (corrMin given)
+# index is the id index of the summaries (see idIndex), processors splits the correlation
+# filter over several processes
+def qualityFlags(summaries, intensities, index, detectMin, corrMin = None, processors = 1):
+  summaries = summaries[["id", "detectCnt", "detectFrac"]].copy()
+  summaries["badFlag"] = 0
+  summaries.loc[(summaries["detectFrac"] < detectMin), "badFlag"] = 1
+  if corrMin is None:
+    return summaries[["badFlag"]]
   summaries.loc[(summaries["detectCnt"] < 3), "badFlag"] = 1
-  ids = summaries[(summaries["badFlag"] == 0)]["id"].drop_duplicates()
-  summaries["corrMean"] = 0
-  for i in ids:
-    frags = summaries.index[(summaries["id"] == i) & (summaries["badFlag"] == 0)].to_numpy()
-    fragCnt = len(frags)
-    print(str(i) + " " + str(frags) + " " + str(fragCnt))
-    if fragCnt > 1:
-      fragCorr = intensities.loc[frags].T.corr().values
-      np.fill_diagonal(fragCorr, np.nan)
-      noOverlap = np.isnan(fragCorr).all(axis=1)
-      summaries.loc[frags[noOverlap], "badFlag"] = 1
-      frags = frags[~noOverlap]
-      fragCorr = fragCorr[~noOverlap, :][:, ~noOverlap]
-      print(str(fragCorr))
-      fragCnt = fragCnt - np.count_nonzero(noOverlap)
-      while fragCnt > 1:
-        meanCorr = np.nanmean(fragCorr, axis=0)
-        worstFrag = np.argmin(meanCorr)
-        print(worstFrag)
-        print(meanCorr)
-        if meanCorr[worstFrag] < corrMin:
-          summaries.loc[frags[worstFrag], "badFlag"] = 1
-          frags = np.delete(frags, worstFrag)
-          fragCorr = np.delete(fragCorr, worstFrag, 0)
-          fragCorr = np.delete(fragCorr, worstFrag, 1)
-          fragCnt -= 1
-        else:
-          for j in range(0, len(frags)):
-            summaries.loc[frags[j], "corrMean"] = meanCorr[j]
-          break
-    if fragCnt <= 1:
-      summaries.loc[frags, "badFlag"] = 1
-
-# identification quality and best fragment identification
-ids = summaries[(summaries["detectCnt"] > 0)]["id"].drop_duplicates()
-summaries["fragCnt"] = 0
-summaries["qualityCnt"] = 0
-summaries["bestFlag"] = 0
-for i in ids:
+  # the remaining fragments of every id, in row order
+  remaining = (summaries["badFlag"] == 0).to_numpy()
+  slots = groupSlots(np.where(remaining, index[0], -1), len(index[2]) - 1)
+  values = intensities.loc[summaries.index].to_numpy(dtype=float)
+  bad, corrMean = parallelCorrelationFilter(values, slots, corrMin, processors)
+  badFlag = summaries["badFlag"].to_numpy().copy()
+  badFlag[slots[bad]] = 1
+  summaries["badFlag"] = badFlag
+  summaries["corrMean"] = 0.0
+  summaries.iloc[slots[slots >= 0], summaries.columns.get_loc("corrMean")] = corrMean[slots >= 0]
+  # corrMean stays an integer column unless a mean has a fraction, as when set row by row
+  if (summaries["corrMean"] % 1 == 0).all():
+    summaries["corrMean"] = summaries["corrMean"].astype(int)
+  return summaries[["badFlag", "corrMean"]]
+
+# Flag the best fragment of every id among the candidates, via detected count and subid
+# The highest detected count is taken over the candidates, the lowest subid over the
+# eligible fragments with that count, and every fragment of the id with that subid is
+# flagged; ids without candidates have no best fragment
+def bestFragments(summaries, index, candidates, eligible):
+  codes = index[0]
+  detectCnt = summaries["detectCnt"].to_numpy(dtype=float)
+  subid = summaries["subid"].to_numpy(dtype=float)
+  detectCntMax = idReduce(np.maximum, np.where(candidates, detectCnt, -np.inf), index)
+  best = eligible & (detectCnt == detectCntMax[codes]) & ~np.isnan(subid)
+  subidMin = idReduce(np.minimum, np.where(best, subid, np.inf), index)
+  return (subid == subidMin[codes]).astype(int)
+
+# Identification quality and best fragment identification
+# index is the id index of the summaries, see idIndex
+def fragmentSummary(summaries, intensities, index):
+  summaries = summaries[["id", "subid", "detectCnt", "badFlag"]].copy()
+  codes = index[0]
+  selected = idReduce(np.maximum, (summaries["detectCnt"] > 0).to_numpy(), index)[codes]
+  good = (summaries["badFlag"] == 0).to_numpy()
   # get the number of detected fragments per id
   # get number of quality detections per id
   #   a quality detection is defined as 3 detected fragments in one sample
-  frags = summaries.index[(summaries["id"] == i) & (summaries["badFlag"] == 0)].tolist()
-  summaries.loc[frags, "fragCnt"] = len(frags)
-  simulCnt = intensities.loc[frags].count(axis=0)
-  summaries.loc[frags, "qualityCnt"] = (simulCnt >= 3).sum()
+  simulCnt = idReduce(np.add, (intensities.loc[summaries.index].notna().to_numpy() & good[:, None]).astype(int), index)
+  summaries["fragCnt"] = np.where(selected & good, idReduce(np.add, good.astype(int), index)[codes], 0)
+  summaries["qualityCnt"] = np.where(selected & good, (simulCnt >= 3).sum(axis=1)[codes], 0)
   # identify the best fragment for analysis via detected count and subid
   #   in the future alternative metrics like CV might be considered
-  detectCntMax = summaries.loc[frags]["detectCnt"].max()
-  subidMin = summaries.loc[(summaries["id"] == i) & (summaries["detectCnt"] == detectCntMax), "subid"].min()
-  summaries.loc[(summaries["id"] == i) & (summaries["subid"] == subidMin), "bestFlag"] = 1
-summaries["qualityFrac"] = summaries["qualityCnt"].div(len(intensities.columns))
-
-# if concentration is provided add associated details
-if quantToggle:
-  summaries["beta"] = quants["beta"]
-  quants = quants[samples]
-  quants[quants == 0] = np.nan
-  if repToggle:
-    # get medians for replicates
-    replicates = pd.DataFrame()
-    for source in sources:
-      replicates[source] = quants[batchinfo[batchinfo["id"] == source]["sample"]].median(axis=1)
-    quants = replicates
-  # identify the best fragment for quantification via detected count and subid and presence of standards
-  ids = summaries[(summaries["badFlag"] == 0) & (summaries["beta"] > 0)]["id"].drop_duplicates()
-  summaries["bestQuantFlag"] = 0
-  for i in ids:
-    frags = summaries.index[(summaries["id"] == i) & (summaries["badFlag"] == 0) & (summaries["beta"] > 0)].tolist()
-    detectCntMax = summaries.loc[frags]["detectCnt"].max()
-    subidMin = summaries.loc[(summaries["id"] == i) & (summaries["detectCnt"] == detectCntMax) & (summaries["beta"] > 0), "subid"].min()
-    summaries.loc[(summaries["id"] == i) & (summaries["subid"] == subidMin), "bestQuantFlag"] = 1
-
-# select and rearrange columns based on selected inputs
-summaryFields = ["mzMed", "rtMed", "tmz", "trt", "id", "subid", "name", "monoisotopic", "formula", "cas", "mzMin", "mzMax", "mzRange", "rtMin", "rtMax", "rtRange", "iMean", "iStd", "iCV"]
-if libsamples:
-  summaryFields = summaryFields + ["libFragCnt", "libQualityFrac"]
-summaryFields = summaryFields + ["detectCnt", "detectFrac", "fragCnt", "qualityCnt", "qualityFrac", "bestFlag", "badFlag"]
-if corrToggle:
-  summaryFields = summaryFields + ["corrMean"]
-if quantToggle:
-  summaryFields = summaryFields + ["beta", "bestQuantFlag"]
-summaries = summaries[summaryFields]
-
-# add intensities or concentrations to summary
-if not quantToggle:
-  summaries = pd.concat([summaries, intensities], axis=1)
-else:
-  summaries = pd.concat([summaries, quants], axis=1)
-  summaries = summaries[summaries["beta"] > 0]
-
-# filter rows
-summaries = summaries[summaries["badFlag"] == 0]
-summaries.drop('badFlag', axis=1, inplace=True)
-
-# write summary file
-summaries.to_csv(summaryname)
+  summaries["bestFlag"] = np.where(selected, bestFragments(summaries, index, good, np.ones(len(good), dtype=bool)), 0)
+  summaries["qualityFrac"] = summaries["qualityCnt"].div(len(intensities.columns))
+  return summaries[["fragCnt", "qualityCnt", "bestFlag", "qualityFrac"]]
+
+# Identify the best fragment for quantification via detected count and subid and presence of standards
+# index is the id index of the summaries, see idIndex
+def quantFlags(summaries, index):
+  summaries = summaries[["id", "subid", "detectCnt", "badFlag", "beta"]].copy()
+  standard = (summaries["beta"] > 0).to_numpy()
+  summaries["bestQuantFlag"] = bestFragments(summaries, index, standard & (summaries["badFlag"] == 0).to_numpy(), standard)
+  return summaries[["bestQuantFlag"]]
+
+# Compute a stage once per cache key
+# Variants summarized from the same inputs share their stages through cache
+def cached(cache, key, stage):
+  if key not in cache:
+    cache[key] = stage()
+  return cache[key]
+
+# Summarize the feature tables read by readInputs
+# repToggle summarizes replicate medians per source id (requires batchinfo), quantToggle
+# concentrations (requires quants in inputs) and corrMin sets the correlation filter,
+# run on processors processes
+# Intermediate results are kept in cache, pass the same dict to summarize several
+# variants of the same inputs, batch file, labels and standards library
+# Returns the summary table as written to the summary file, without the sample or
+# replicate values when withValues is off
+def summarize(inputs, batchinfo = None, labels = ["subject"], stdlib = None, repToggle = False, quantToggle = False, corrMin = None, detectMin = sys.float_info.min, cache = None, processors = 1, withValues = True):
+  if cache is None:
+    cache = {}
+  intensityRows, intensities = inputs["intensities"]
+  samples, sources, libsamples, libsources = cached(cache, "samples", lambda: selectSamples(intensities, batchinfo, labels, stdlib))
+
+  # create initial fragment summaries
+  summaries = inputs["masscharges"][0][["tmz", "trt", "id", "subid", "name", "monoisotopic", "cas", "formula"]].copy()
+  index = cached(cache, "idIndex", lambda: idIndex(summaries["id"]))
+
+  # sample values of every feature table, replicate medians in one pass
+  # the quant table only has the subject samples and is taken on its own, for quant summaries
+  names = ["rtimes", "masscharges", "intensities"]
+  matrices = cached(cache, ("values", repToggle), lambda: dict(zip(names, subjectValues([inputs[name][1] for name in names], samples, sources, batchinfo, repToggle))))
+  rtimes = matrices["rtimes"]
+  masscharges = matrices["masscharges"]
+  values = matrices["intensities"]
+
+  # summarize rtimes and masses
+  summaries = summaries.join(cached(cache, ("rtSummary", repToggle), lambda: rangeSummary(rtimes, "rt")))
+  summaries = summaries.join(cached(cache, ("mzSummary", repToggle), lambda: rangeSummary(masscharges, "mz")))
+
+  # summarize standards if library provided
+  if libsamples:
+    libintensities = cached(cache, ("libintensities", repToggle), lambda: subjectValues([intensities], libsamples, libsources, batchinfo, repToggle)[0])
+    summaries = summaries.join(cached(cache, ("libSummary", repToggle), lambda: librarySummary(summaries, libintensities, index)))
+
+  # summarize intensities
+  summaries = summaries.join(cached(cache, ("iSummary", repToggle), lambda: intensitySummary(values)))
+
+  # quality-based filtering, optionally on correlation
+  summaries = summaries.join(cached(cache, ("flags", repToggle, corrMin, detectMin), lambda: qualityFlags(summaries, values, index, detectMin, corrMin, processors)))
+
+  # identification quality and best fragment identification
+  summaries = summaries.join(cached(cache, ("fragSummary", repToggle, corrMin, detectMin), lambda: fragmentSummary(summaries, values, index)))
+
+  # if concentration is provided add associated details
+  if quantToggle:
+    summaries["beta"] = inputs["quants"][0]["beta"]
+    quants = cached(cache, ("quants", repToggle), lambda: subjectValues([inputs["quants"][1]], samples, sources, batchinfo, repToggle)[0])
+    summaries = summaries.join(cached(cache, ("quantFlags", repToggle, corrMin, detectMin), lambda: quantFlags(summaries, index)))
+
+  # select and rearrange columns based on selected inputs
+  summaryFields = ["mzMed", "rtMed", "tmz", "trt", "id", "subid", "name", "monoisotopic", "formula", "cas", "mzMin", "mzMax", "mzRange", "rtMin", "rtMax", "rtRange", "iMean", "iStd", "iCV"]
+  if libsamples:
+    summaryFields = summaryFields + ["libFragCnt", "libQualityFrac"]
+  summaryFields = summaryFields + ["detectCnt", "detectFrac", "fragCnt", "qualityCnt", "qualityFrac", "bestFlag", "badFlag"]
+  if corrMin is not None:
+    summaryFields = summaryFields + ["corrMean"]
+  if quantToggle:
+    summaryFields = summaryFields + ["beta", "bestQuantFlag"]
+  summaries = summaries[summaryFields]
+
+  # add intensities or concentrations to summary
+  if withValues:
+    summaries = pd.concat([summaries, quants if quantToggle else values], axis=1)
+  if quantToggle:
+    summaries = summaries[summaries["beta"] > 0]
+
+  # filter rows
+  summaries = summaries[summaries["badFlag"] == 0]
+  summaries.drop('badFlag', axis=1, inplace=True)
+  return summaries
+
+# Summarize feature tables out of core, in blocks of target rows
+# jobs are the (repToggle, quantToggle, corrMin, summaryname) of every summary file to
+# write, the other arguments are those of summarize; inputs are best read mapped
+# Every fragment statistic only depends on the rows of its own id, so a first pass
+# summarizes blocks of whole ids, about chunk rows each, and keeps the fragment fields
+# of every summary; a second pass writes the summary files in blocks of chunk rows, with
+# the sample values or replicate medians of each block
+# Only a block of the value tables is held in memory at a time, the files are the same
+# as summarize writes
+# Returns the summary files written
+def summarizeBlocks(inputs, jobs, batchinfo = None, labels = ["subject"], stdlib = None, detectMin = sys.float_info.min, processors = 1, chunk = 10000):
+  rows = inputs["masscharges"][0]
+  codes, order, starts = idIndex(rows["id"])
+  samples, sources, libsamples, libsources = selectSamples(inputs["intensities"][1], batchinfo, labels, stdlib)
+
+  # fragment fields of blocks of whole ids, rows of a block in table order
+  blocks = []
+  first = 0
+  while first < len(starts) - 1:
+    last = max(np.searchsorted(starts, starts[first] + chunk, side="right") - 1, first + 1)
+    blocks.append(np.sort(order[starts[first]:starts[last]]))
+    first = last
+  fields = [[] for job in jobs]
+  for block in blocks or [order]:
+    blockInputs = {name: (table[0].iloc[block], table[1].iloc[block]) for name, table in inputs.items()}
+    cache = {}
+    for j, (repToggle, quantToggle, corrMin, summaryname) in enumerate(jobs):
+      fields[j].append(summarize(blockInputs, batchinfo, labels, stdlib, repToggle, quantToggle, corrMin, detectMin, cache, processors, withValues=False))
+  fields = [pd.concat(parts) for parts in fields]
+  positions = [rows.index.get_indexer(summary.index) for summary in fields]
+  fields = [summary.iloc[np.argsort(position, kind="stable")] for summary, position in zip(fields, positions)]
+  positions = [np.sort(position) for position in positions]
+
+  # summary files with the values of blocks of rows
+  for start in range(0, max(len(rows), 1), chunk):
+    values = {}
+    for j, (repToggle, quantToggle, corrMin, summaryname) in enumerate(jobs):
+      name = "quants" if quantToggle else "intensities"
+      if (name, repToggle) not in values:
+        values[(name, repToggle)] = subjectValues([inputs[name][1].iloc[start:start+chunk]], samples, sources, batchinfo, repToggle)[0]
+      lower, upper = np.searchsorted(positions[j], [start, start + chunk])
+      summary = fields[j].iloc[lower:upper]
+      summary = pd.concat([summary, values[(name, repToggle)].loc[summary.index]], axis=1)
+      summary.to_csv(summaryname, mode="w" if start == 0 else "a", header=(start == 0))
+  return [summaryname for repToggle, quantToggle, corrMin, summaryname in jobs]
+
+# Summarize several variants of the same inputs in one pass
+# variants are variant names, see parseVariant; corrMin is the correlation filter of
+# the .corr variants
+# Inputs are read once and the stages the variants have in common are computed once
+# chunk summarizes out of core in blocks of about chunk target rows, see summarizeBlocks
+# Returns the summary file written for each variant
+def summarizeVariants(featuresLoc, variants, batchinfo = None, labels = ["subject"], stdlib = None, corrMin = None, inputNames = None, processors = 1, chunk = None):
+  toggles = [parseVariant(variant) for variant in variants]
+  if any(corrToggle for repToggle, quantToggle, corrToggle in toggles) and corrMin is None:
+    raise ValueError("correlation variants need a correlation threshold")
+  inputNames = dict(inputNames or {})
+  quantsLoc = inputNames.pop("quantsLoc", None)
+  if any(quantToggle for repToggle, quantToggle, corrToggle in toggles):
+    inputNames["quantsLoc"] = quantsLoc or quantsName
+  inputs = readInputs(featuresLoc, mapped=chunk is not None, **inputNames)
+  if chunk is not None:
+    jobs = [(repToggle, quantToggle, corrMin if corrToggle else None, featuresLoc + "feature." + variant + ".csv") for variant, (repToggle, quantToggle, corrToggle) in zip(variants, toggles)]
+    return summarizeBlocks(inputs, jobs, batchinfo, labels, stdlib, processors=processors, chunk=chunk)
+  cache = {}
+  written = []
+  for variant, (repToggle, quantToggle, corrToggle) in zip(variants, toggles):
+    summary = summarize(inputs, batchinfo, labels, stdlib, repToggle, quantToggle, corrMin if corrToggle else None, cache=cache, processors=processors)
+    summaryname = featuresLoc + "feature." + variant + ".csv"
+    summary.to_csv(summaryname)
+    written.append(summaryname)
+  return written
+
+def main():
+  # get input options
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "f:i:r:m:q:n:b:l:s:c:p:xh", ["quant", "variants=", "chunk="])
+  except getopt.GetoptError as err:
+    print(err)
+    sys.exit(2)
+  # required parameters
+  featuresLoc = ""
+  inputNames = {"intensitiesLoc": intensitiesName, "rtimesLoc": rtimesName, "masschargesLoc": masschargesName}
+  quantsLoc = None # quantification file, feature.sample.quant.csv by default
+  summaryname = None # summary file naming, by default after the variant
+  # additional parameters
+  batchinfo = None # batch file
+  labels = ["subject"] # sample type filter
+  stdlib = None # standards library
+  repToggle = False # toggles replicate summarization
+  quantToggle = False # toggles quantification options
+  corrMin = None
+  processors = 1 # processes for the correlation filter
+  chunk = None # target rows per block of the out-of-core summary
+  variants = None
+  for o, a in opts:
+    if o == "-h":
+      print("PeakWalk: Automated GC Identification and Quantification")
+      print("-f feature files location, optional")
+      print("  default feature files location is working directory")
+      print("  sets location for input and output")
+      print("-i intensity file, optional")
+      print("-r retention time file, optional")
+      print("-m masscharge file, optional")
+      print("  -irm are optional, but feature files are required, see -f")
+      print("  default file names are feature.sample.{i, mz, rt}.csv")
+      print("-q quantification file, optional, requires -b")
+      print("  overrides intensity with concentration")
+      print("-n summary file name, optional")
+      print("-b batch file, optional")
+      print("-l filter labels, optional, comma-separated, requires -b")
+      print("-s standards library, optional, function not implemented")
+      print("-x toggle replicate summarization, optional, requires -b")
+      print("-c sets correlation filter, optional")
+      print("-p number of processes for the correlation filter, optional")
+      print("--variants writes several summaries from one read of the inputs, optional")
+      print("  comma-separated <sample|subject>.<summary|qsummary>[.corr]")
+      print("  each is written to feature.<variant>.csv, .corr variants use -c")
+      print("  qsummary variants read -q, -x -n and --quant do not apply")
+      print("--chunk summarizes out of core in blocks of about this many target rows, optional")
+      print("-h help, optional")
+      sys.exit()
+    if o == "-f":
+      featuresLoc = a + "/"
+    if o == "-i":
+      print(a)
+      inputNames["intensitiesLoc"] = a
+    if o == "-r":
+      inputNames["rtimesLoc"] = a
+    if o == "-m":
+      inputNames["masschargesLoc"] = a
+    if o == "-q":
+      quantToggle = True
+      quantsLoc = a
+    if o == "--quant":
+      quantToggle = True
+    if o == "-n":
+      summaryname = a
+    if o == "-b":
+      batchinfo = pd.read_csv(os.path.abspath(a), sep=",")
+    if o == "-l":
+      labels = a.split(",")
+    if o == "-s":
+      stdlib = a
+    if o == "-x":
+      repToggle = True
+    if o == "-c":
+      corrMin = float(a)
+    if o == "-p":
+      processors = int(a)
+    if o == "--variants":
+      variants = a.split(",")
+    if o == "--chunk":
+      chunk = int(a)
+
+  if variants:
+    if repToggle or (quantToggle and not quantsLoc) or summaryname is not None:
+      print("-x, -n and --quant do not apply to --variants, the variant names set them")
+      sys.exit(2)
+    try:
+      for summaryname in summarizeVariants(featuresLoc, variants, batchinfo, labels, stdlib, corrMin, dict(inputNames, quantsLoc=quantsLoc), processors, chunk):
+        print(summaryname)
+    except ValueError as err:
+      print(err)
+      sys.exit(2)
+    return
+
+  # read in data based on input
+  inputs = readInputs(featuresLoc, quantsLoc=(quantsLoc or quantsName) if quantToggle else None, mapped=chunk is not None, **inputNames)
+  if summaryname is None:
+    summaryname = "feature." + variantName(repToggle, quantToggle, False) + ".csv"
+  if chunk is not None:
+    summarizeBlocks(inputs, [(repToggle, quantToggle, corrMin, featuresLoc + summaryname)], batchinfo, labels, stdlib, processors=processors, chunk=chunk)
+    return
+  summary = summarize(inputs, batchinfo, labels, stdlib, repToggle, quantToggle, corrMin, processors=processors)
+
+  # write summary file
+  summary.to_csv(featuresLoc + summaryname)
 
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+# Micro-benchmarks for the GCCombo matching kernels
+# Each kernel runs on a synthetic sample (see synthData.py) at a few scale tiers
+#   candidateSearch  mz and rt window search of the targets in the sample
+#   matchDTW         DTW scoring and queued matching of the candidates
+#   irtFilter        inferred rt and delta rt of every id after DTW matching
+#   firstShot        one first-shot pass after DTW matching
+#   secondShot       second-shot correction after a first-shot pass
+#   targetSearch     the whole search of the sample
+# Inputs are rebuilt before every run and are not timed
+# Time is the best and median of the repeats; peak memory is the python and numpy
+# allocations of one further run traced with tracemalloc (numba kernels mostly work in place)
+# --save writes the results as a baseline, --baseline compares against one and exits
+# with 1 when a kernel got slower or larger than the tolerance allows
+# usage: benchKernels.py [-t small,medium] [-k kernels] [-r repeats] [-e seed] [--dtw=exact] [--save baseline.json] [--baseline baseline.json] [--tolerance 0.25]
+
+# os operation libraries
+import sys
+import os
+import getopt
+import json
+import time
+import tracemalloc
+
+# data libraries
+import numpy as np
+
+# kernels under test, target bounds and the synthetic data generator
+import GCCombo
+from GCCombo import candidateSearch, searchFrames, searchState, matchDTW, irtFilter, firstShot, secondShot, targetSearch, compileKernels
+from targetIndex import addBounds
+from synthData import synthTargets, synthSample, synthDrift
+
+# Scale tiers: target ids, fragments per id, noise features per fragment
+tiers = {
+  "small": {"ids": 50, "fragments": 6, "density": 10.0},
+  "medium": {"ids": 100, "fragments": 6, "density": 20.0},
+  "large": {"ids": 300, "fragments": 6, "density": 40.0}
+  }
+kernels = ["candidateSearch", "matchDTW", "irtFilter", "firstShot", "secondShot", "targetSearch"]
+trtBound = 0.3
+drift = 0.25
+
+# Generate the targets and sample of a tier
+def benchData(tier, seed):
+  rng = np.random.default_rng(seed)
+  targets = addBounds(synthTargets(tiers[tier]["ids"], tiers[tier]["fragments"], rng), trtBound)
+  sample, truth = synthSample(targets, "S000", tiers[tier]["density"], synthDrift(drift, 0, 1), rng)
+  sample = sample.iloc[:, [0, 1, 3]]
+  sample.columns = ["mz", "rt", "S000"]
+  return (targets, sample)
+
+# Matching states of a sample as (state, drtBound) after each stage
+# "state" is the fresh state, "dtw" after DTW matching and "firstShot" after one first-shot pass
+def benchStates(data, dtwMethod):
+  state = searchState(*searchFrames(candidateSearch(data[0], data[1])))
+  states = {"state": (copyState(state), 0)}
+  matchDTW(state, {}, dtwMethod)
+  states["dtw"] = (copyState(state), 0)
+  drtBound = firstShot(state)[0]
+  states["firstShot"] = (state, drtBound)
+  return states
+
+# Copy a matching state, so every run starts from the same arrays
+def copyState(state):
+  return {k: v.copy() for k, v in state.items()}
+
+# Input builder and run of each kernel
+def benchKernel(kernel, data, states, dtwMethod):
+  stateAfter = lambda stage: (copyState(states[stage][0]), states[stage][1])
+  if kernel == "candidateSearch":
+    return (lambda: data, lambda inputs: candidateSearch(*inputs))
+  if kernel == "matchDTW":
+    return (lambda: stateAfter("state"), lambda inputs: matchDTW(inputs[0], {}, dtwMethod))
+  if kernel == "irtFilter":
+    return (lambda: stateAfter("dtw"), lambda inputs: irtFilter(inputs[0]))
+  if kernel == "firstShot":
+    return (lambda: stateAfter("dtw"), lambda inputs: firstShot(inputs[0]))
+  if kernel == "secondShot":
+    return (lambda: stateAfter("firstShot"), lambda inputs: secondShot(inputs[0], inputs[1]))
+  return (lambda: data, lambda inputs: targetSearch(inputs[0], inputs[1], 1, True, {}, dtwMethod))
+
+# Time one kernel and trace its peak memory
+def measure(setup, run, repeats):
+  times = []
+  for r in range(0, repeats):
+    inputs = setup()
+    start = time.perf_counter()
+    run(inputs)
+    times.append(time.perf_counter() - start)
+  inputs = setup()
+  tracemalloc.start()
+  run(inputs)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return {"best": min(times), "median": float(np.median(times)), "peak": peak}
+
+# Compare results against a baseline
+# Returns the (tier, kernel, measure, baseline, result) of every regression
+def regressions(results, baseline, tolerance):
+  found = []
+  for tier, measured in results["tiers"].items():
+    for kernel, result in measured.items():
+      previous = baseline["tiers"].get(tier, {}).get(kernel)
+      if previous is None:
+        continue
+      for key in ["best", "peak"]:
+        if result[key] > previous[key] * (1 + tolerance):
+          found.append((tier, kernel, key, previous[key], result[key]))
+  return found
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "t:k:r:e:", ["dtw=", "save=", "baseline=", "tolerance="])
+  except getopt.GetoptError as err:
+    print(err)
+    sys.exit(2)
+  selectedTiers = ["small", "medium"]
+  selectedKernels = kernels
+  repeats = 5
+  seed = 3
+  dtwMethod = "exact"
+  save = None
+  baseline = None
+  tolerance = 0.25
+  for o, a in opts:
+    if o == "-t":
+      selectedTiers = a.split(",")
+    elif o == "-k":
+      selectedKernels = a.split(",")
+    elif o == "-r":
+      repeats = int(a)
+    elif o == "-e":
+      seed = int(a)
+    elif o == "--dtw":
+      dtwMethod = a
+    elif o == "--save":
+      save = os.path.abspath(a)
+    elif o == "--baseline":
+      baseline = os.path.abspath(a)
+    elif o == "--tolerance":
+      tolerance = float(a)
+  unknown = [t for t in selectedTiers if t not in tiers] + [k for k in selectedKernels if k not in kernels] + ([dtwMethod] if dtwMethod not in GCCombo.dtwMethods else [])
+  if unknown:
+    print("unknown tiers, kernels or dtw method: " + ", ".join(unknown))
+    sys.exit(2)
+
+  compileKernels()
+  results = {"dtw": dtwMethod, "numba": GCCombo.njit is not None, "seed": seed, "repeats": repeats, "tiers": {}}
+  print("tier".ljust(8) + "kernel".ljust(17) + "best s".rjust(10) + "median s".rjust(10) + "peak MB".rjust(10) + "  size")
+  for tier in selectedTiers:
+    data = benchData(tier, seed)
+    states = benchStates(data, dtwMethod)
+    size = str(len(data[0])) + " targets, " + str(len(data[1])) + " features"
+    results["tiers"][tier] = {}
+    for kernel in selectedKernels:
+      setup, run = benchKernel(kernel, data, states, dtwMethod)
+      # warm up caches and lazily compiled code
+      run(setup())
+      result = measure(setup, run, repeats)
+      results["tiers"][tier][kernel] = result
+      print(tier.ljust(8) + kernel.ljust(17) + ("%.4f" % result["best"]).rjust(10) + ("%.4f" % result["median"]).rjust(10) + ("%.2f" % (result["peak"] / 2**20)).rjust(10) + "  " + size)
+
+  if save:
+    with open(save, "w") as saved:
+      json.dump(results, saved, indent=2)
+  if baseline:
+    with open(baseline) as saved:
+      baseline = json.load(saved)
+    if (baseline.get("dtw"), baseline.get("numba")) != (results["dtw"], results["numba"]):
+      print("baseline was measured with dtw " + str(baseline.get("dtw")) + ", numba " + str(baseline.get("numba")))
+    found = regressions(results, baseline, tolerance)
+    for tier, kernel, key, previous, result in found:
+      print("regression: " + tier + " " + kernel + " " + key + " " + ("%.4g" % previous) + " -> " + ("%.4g" % result))
+    if found:
+      sys.exit(1)
+    print("no regressions")
+
+if __name__ == "__main__":
+  main()
@@ -10,7 +10,8 @@ fileType = sys.argv[2]
 fileName = "feature." + fileType + ".csv"
 libs = []
 for libDir in os.listdir(featDir):
-  if os.path.isdir(featDir + "/" + libDir):
+  # run directories next to the libraries (metrics, search.cache, target indexes) hold no feature tables
+  if os.path.isfile(featDir + "/" + libDir + "/" + fileName):
     lib = pd.read_csv(featDir + "/" + libDir + "/" + fileName)
     lib.insert(0, "lib", re.search(r'.*?([^\/]+)\/?$', libDir).group(1))
     libs.append(lib)
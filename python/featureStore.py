@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+# Binary feature store shared by GCCombo, GCSummary and GCQuant
+# A feature table feature.sample.i.csv is kept next to its CSV export as
+#   feature.sample.i.store/values.npy  target rows x samples matrix, column-major
+#   feature.sample.i.store/rows.csv    target list columns, one line per row
+#   feature.sample.i.store/meta.json   sample names and dtype, written last
+# values.npy is memory-mapped on read so only the sample columns used are paged in
+
+# os operation libraries
+import os
+import json
+import tempfile
+
+# data libraries
+import numpy as np
+import pandas as pd
+
+# Target list and quantification columns that lead a feature CSV
+# Every other column of a feature CSV is a sample
+rowColumns = [
+  "id", "name", "tmz", "trt", "monoisotopic", "cas", "subid", "formula", "concentration", "note", "realRt",
+  "tmzupper", "tmzlower", "trtupper", "trtlower", "dsamp", "dconc", "beta", "rsquared"
+  ]
+storeDtypes = ["float64", "float32"]
+csvChunk = 10000 # target rows per block of the CSV export
+
+# Store directory for a feature CSV path
+def storePath(path):
+  return os.path.splitext(os.path.abspath(path))[0] + ".store"
+
+# Open the values of a feature table for writing
+# Returns a zero-filled rows x samples matrix, column-major and memory-mapped in the store,
+# so it can be filled a sample at a time without holding it in memory
+# Any previous manifest is dropped first so a half-written store is never picked up
+def openFeatures(path, rowCount, sampleCount, dtype="float64"):
+  store = storePath(path)
+  os.makedirs(store, exist_ok=True)
+  if os.path.exists(store + "/meta.json"):
+    os.remove(store + "/meta.json")
+  return np.lib.format.open_memmap(store + "/values.tmp.npy", mode="w+", dtype=dtype, shape=(rowCount, sampleCount), fortran_order=True)
+
+# Finish a feature table opened with openFeatures
+# The CSV export keeps the layout the scripts have always written and is written
+# in blocks of target rows; the manifest goes last
+def closeFeatures(path, rows, values, samples, csv=True):
+  rows = rows.reset_index(drop=True)
+  values.flush()
+  if csv:
+    for start in range(0, max(len(rows), 1), csvChunk):
+      stop = min(start + csvChunk, len(rows))
+      block = pd.DataFrame(values[start:stop], columns=samples, index=range(start, stop))
+      pd.concat([rows.iloc[start:stop], block], axis=1).to_csv(path, mode="w" if start == 0 else "a", header=(start == 0))
+  store = storePath(path)
+  os.replace(store + "/values.tmp.npy", store + "/values.npy")
+  rows.to_csv(store + "/rows.tmp.csv", index=False)
+  os.replace(store + "/rows.tmp.csv", store + "/rows.csv")
+  with open(store + "/meta.tmp.json", "w") as meta:
+    json.dump({"samples": [str(s) for s in samples], "dtype": str(values.dtype), "rows": len(rows)}, meta)
+  os.replace(store + "/meta.tmp.json", store + "/meta.json")
+
+# Write a feature table as rows (target columns) plus a rows x samples matrix
+def writeFeatures(path, rows, values, samples, dtype="float64", csv=True):
+  stored = openFeatures(path, len(rows), len(samples), dtype)
+  stored[...] = values
+  closeFeatures(path, rows, stored, samples, csv)
+
+# Check that a store exists and is not older than its CSV export
+def storeCurrent(path):
+  meta = storePath(path) + "/meta.json"
+  if not os.path.exists(meta):
+    return False
+  if os.path.exists(path) and os.stat(meta).st_mtime_ns < os.stat(path).st_mtime_ns:
+    return False
+  return True
+
+# Read a feature table as (rows, values)
+# values is a samples-column DataFrame, backed by the memory-mapped store when current
+# Otherwise the CSV is parsed and split on the known target columns
+def readFeatures(path, mmap=True):
+  if storeCurrent(path):
+    store = storePath(path)
+    with open(store + "/meta.json") as meta:
+      meta = json.load(meta)
+    rows = pd.read_csv(store + "/rows.csv", sep=",", float_precision="round_trip")
+    values = np.load(store + "/values.npy", mmap_mode="r" if mmap else None)
+    values = pd.DataFrame(values, columns=meta["samples"], copy=False)
+    return rows, values
+  features = pd.read_csv(os.path.abspath(path), sep=",", index_col=0, float_precision="round_trip")
+  features.index.name = None
+  leading = [c for c in features.columns if c in rowColumns]
+  return features[leading], features.drop(columns=leading)
+
+# Read a feature table as (rows, values) without holding the values in memory
+# A current store is memory-mapped as in readFeatures; a CSV export is parsed in blocks
+# of target rows into a temporary memory-mapped matrix, unlinked once it is mapped
+def mapFeatures(path, dtype="float64"):
+  if storeCurrent(path):
+    return readFeatures(path)
+  path = os.path.abspath(path)
+  header = pd.read_csv(path, sep=",", index_col=0, nrows=0)
+  leading = [c for c in header.columns if c in rowColumns]
+  samples = [c for c in header.columns if c not in rowColumns]
+  rowCount = sum(len(block) for block in pd.read_csv(path, sep=",", usecols=[0], chunksize=csvChunk))
+  with tempfile.TemporaryDirectory() as tmpdir:
+    values = np.lib.format.open_memmap(tmpdir + "/values.npy", mode="w+", dtype=dtype, shape=(rowCount, len(samples)), fortran_order=True)
+  rows = []
+  start = 0
+  for block in pd.read_csv(path, sep=",", index_col=0, chunksize=csvChunk, float_precision="round_trip"):
+    values[start:start+len(block)] = block[samples].to_numpy(dtype=dtype)
+    rows.append(block[leading])
+    start += len(block)
+  rows = pd.concat(rows) if rows else header[leading]
+  rows.index.name = None
+  return rows, pd.DataFrame(values, columns=samples, copy=False)
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+# Run report of the GCCombo worker metrics
+# Merges the worker.<pid>.jsonl files of a feature directory's metrics directory
+# (one line per sample and library) with its run.json and prints
+#   the run settings and wall times
+#   the time spent in every stage, overall and per sample
+#   the candidate, match and first-shot iteration counts
+#   the samples, busy time and peak resident memory of every worker
+#   the slowest samples
+# -o also writes the merged per-sample metrics as a CSV
+# usage: metricsReport.py -f featuredir [-o metrics.csv] [-n slowest]
+
+# os operation libraries
+import sys
+import os
+import getopt
+import json
+
+# data libraries
+import numpy as np
+import pandas as pd
+
+# Stages in the order they run, see runSample, searchLibrary and targetSearch
+# search holds shift and the targetSearch stages, total every stage of the sample and library
+stages = ["cacheRead", "read", "shift", "candidateSearch", "searchState", "dtw", "firstShot", "secondShot", "search", "cacheWrite", "store", "total"]
+counts = ["features", "candidates", "matched", "searches", "firstShotIterations"]
+
+# Read the metrics of a run as one row per sample and library
+def readMetrics(metricsdir):
+  lines = []
+  for name in sorted(os.listdir(metricsdir)):
+    if name.startswith("worker.") and name.endswith(".jsonl"):
+      with open(metricsdir + "/" + name) as worker:
+        lines += [json.loads(line) for line in worker if line.strip()]
+  metrics = pd.DataFrame(lines)
+  for c in stages + counts:
+    if c not in metrics.columns:
+      metrics[c] = np.nan
+  # drtBound holds one bound per targetSearch pass, the last one is the final search
+  if "drtBound" in metrics.columns:
+    metrics["drtBound"] = [b[-1] if isinstance(b, list) and len(b) > 0 else np.nan for b in metrics["drtBound"]]
+  return metrics
+
+# Summary of each stage over the samples
+def stageReport(metrics):
+  times = metrics[stages]
+  report = pd.DataFrame({
+    "total s": times.sum(),
+    "mean s": times.mean(),
+    "p50 s": times.quantile(0.5),
+    "p95 s": times.quantile(0.95),
+    "max s": times.max()
+    })
+  report["share"] = report["total s"] / times["total"].sum()
+  return report
+
+# Summary of each worker
+def workerReport(metrics, run):
+  workers = metrics.groupby("worker").agg(samples=("sample", "nunique"), busy=("total", "sum"), peakRss=("peakRss", "max"))
+  workers["peakRss MB"] = workers.pop("peakRss") / 2**20
+  if run and run.get("search"):
+    workers["busy share"] = workers["busy"] / run["search"]
+  return workers.rename(columns={"busy": "busy s"})
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "f:o:n:")
+  except getopt.GetoptError as err:
+    print(err)
+    sys.exit(2)
+  featuredir = None
+  output = None
+  slowest = 10
+  for o, a in opts:
+    if o == "-f":
+      featuredir = os.path.abspath(a)
+    elif o == "-o":
+      output = os.path.abspath(a)
+    elif o == "-n":
+      slowest = int(a)
+  if not featuredir:
+    print("missing options")
+    sys.exit(2)
+  metricsdir = featuredir + "/metrics"
+  metrics = readMetrics(metricsdir)
+  if len(metrics) == 0:
+    print("no metrics in " + metricsdir)
+    sys.exit(1)
+  run = None
+  if os.path.exists(metricsdir + "/run.json"):
+    with open(metricsdir + "/run.json") as runFile:
+      run = json.load(runFile)
+
+  pd.set_option("display.width", 200)
+  pd.set_option("display.max_columns", 20)
+  if run:
+    print("run: " + ", ".join(k + " " + str(v) for k, v in run.items() if k not in ["search", "write"]))
+    print("wall: search %.2f s, write %.2f s" % (run["search"], run["write"]))
+  print("samples: " + str(metrics["sample"].nunique()) + ", searched " + str(int((~metrics["cached"]).sum())) + ", cached " + str(int(metrics["cached"].sum())))
+  print("\nstages")
+  print(stageReport(metrics).dropna(how="all").round(4).to_string())
+  print("\ncounts per sample")
+  print(metrics[counts].describe().loc[["mean", "min", "50%", "max"]].round(1).to_string())
+  if "drtBound" in metrics.columns:
+    print("\ndrtBound: mean %.4f, min %.4f, max %.4f" % (metrics["drtBound"].mean(), metrics["drtBound"].min(), metrics["drtBound"].max()))
+  print("\nworkers")
+  print(workerReport(metrics, run).round(3).to_string())
+  print("\nslowest samples")
+  print(metrics.sort_values("total", ascending=False).head(slowest)[["sample", "library", "worker", "cached", "total", "read", "dtw", "candidates"]].round(4).to_string(index=False))
+  if output:
+    metrics.to_csv(output, index=False)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+# Synthetic ADAP feature tables and target lists
+# Writes a dataset GCCombo can search, with its ground truth
+#   targets.csv     target list, ids with one or more fragments (subids) sharing an rt
+#   adap/<s>.csv    ADAP-like feature table per sample: detected fragments, decoys
+#                   near each fragment mz and uniform noise features
+#   truth/<s>.csv   id, subid, mz and rt of every detected fragment
+#   batch.csv       injection list: a dilution series of standards, then subject replicates
+# Density is the number of noise features per target fragment, drift the largest rt
+# shift in minutes; each sample drifts along a smooth curve that grows with injection order
+# usage: synthData.py -o outdir [-n ids] [-k fragments] [-s samples] [-q standards] [-d density] [-r drift] [-e seed]
+
+# os operation libraries
+import sys
+import os
+import getopt
+
+# data libraries
+import numpy as np
+import pandas as pd
+
+# Dataset layout
+targetColumns = ["id","name","tmz","trt","monoisotopic","cas","subid","formula","concentration"]
+mzRange = (50.0, 500.0)
+rtRange = (5.0, 40.0) # target rts, sample features spread a minute further
+detection = 0.85 # chance a fragment is detected in a sample
+decoys = 0.5 # decoy features per fragment, same mz and just outside the matched rt
+mzError = 0.000002 # relative mz noise, 2 ppm
+rtError = 0.004 # rt noise in minutes
+batchSize = 12 # injections per batch
+
+# Generate a target list of ids with 1 to fragments subids each
+def synthTargets(ids, fragments, rng):
+  rows = []
+  for i in range(1, ids+1):
+    trt = round(rng.uniform(*rtRange), 3)
+    concentration = float(rng.choice([1, 2]))
+    for s in range(1, int(rng.integers(1, fragments+1))+1):
+      rows.append([i, "c" + str(i), round(rng.uniform(*mzRange), 4), trt, 100.0, "x", s, "C", concentration])
+  return pd.DataFrame(rows, columns=targetColumns)
+
+# Rt drift of one injection, as a function of target rt
+# The curve bends over the run and its amplitude grows with the injection position
+def synthDrift(drift, position, injections):
+  amplitude = drift * (position+1) / max(injections, 1)
+  middle = sum(rtRange) / 2
+  return lambda rt: amplitude * (0.8*np.sin(rt/5.0) + 0.6*(rt-middle)/middle)
+
+# Generate the feature table of one sample and its ground truth
+# scale multiplies the intensity of detected fragments (dilution of a standard)
+def synthSample(targets, name, density, shift, rng, scale = 1.0):
+  tmz = targets.tmz.to_numpy()
+  trt = targets.trt.to_numpy()
+  detected = rng.random(len(targets)) < detection
+  mz = tmz[detected] * (1 + rng.normal(0, mzError, detected.sum()))
+  rt = trt[detected] + shift(trt[detected]) + rng.normal(0, rtError, detected.sum())
+  intensity = rng.lognormal(10, 1, len(targets))[detected] * scale
+
+  # Decoys share a fragment mz but sit 0.05 to 0.3 minutes away from it
+  decoy = rng.integers(0, len(targets), int(len(targets)*decoys))
+  decoyMz = tmz[decoy] * (1 + rng.normal(0, mzError, len(decoy)))
+  decoyRt = trt[decoy] + shift(trt[decoy]) + rng.choice([-1, 1], len(decoy)) * rng.uniform(0.05, 0.3, len(decoy))
+  noise = int(len(targets)*density)
+  noiseMz = rng.uniform(*mzRange, noise)
+  noiseRt = rng.uniform(rtRange[0]-1, rtRange[1]+1, noise)
+
+  mzs = np.round(np.concatenate([mz, decoyMz, noiseMz]), 4)
+  rts = np.round(np.concatenate([rt, decoyRt, noiseRt]), 4)
+  intensities = np.round(np.concatenate([intensity, rng.lognormal(10, 1, len(decoy)+noise)]), 1)
+  sample = pd.DataFrame({"row m/z": mzs, "row retention time": rts, "height": intensities*0.1, name + ".mzXML Peak area": intensities})
+  truth = targets.loc[detected, ["id","subid"]].reset_index(drop=True)
+  truth["mz"] = mzs[:detected.sum()]
+  truth["rt"] = rts[:detected.sum()]
+  return sample, truth
+
+# Generate and write a dataset
+# The first standards samples are a BP1 dilution series (1, 2, 4, ...), the rest are
+# subjects injected as pairs of replicates
+def synthDataset(outdir, ids = 150, fragments = 6, samples = 6, standards = 3, density = 40.0, drift = 0.25, seed = 3):
+  rng = np.random.default_rng(seed)
+  os.makedirs(outdir + "/adap", exist_ok=True)
+  os.makedirs(outdir + "/truth", exist_ok=True)
+  targets = synthTargets(ids, fragments, rng)
+  targets.to_csv(outdir + "/targets.csv", index=False)
+  batch = []
+  for position in range(0, samples):
+    name = "S%03d" % position
+    if position < standards:
+      batch.append([name, "BP1", float(2**position), position // batchSize + 1, "std0"])
+    else:
+      batch.append([name, "subject", np.nan, position // batchSize + 1, "sub" + str((position-standards) // 2)])
+    scale = batch[-1][2] if position < standards else 1.0
+    sample, truth = synthSample(targets, name, density, synthDrift(drift, position, samples), rng, scale)
+    sample.to_csv(outdir + "/adap/" + name + ".csv", index=False)
+    truth.to_csv(outdir + "/truth/" + name + ".csv", index=False)
+  pd.DataFrame(batch, columns=["sample","type","dilu","batch","id"]).to_csv(outdir + "/batch.csv", index=False)
+  return outdir
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "o:n:k:s:q:d:r:e:")
+  except getopt.GetoptError as err:
+    print(err)
+    sys.exit(2)
+  outdir = None
+  settings = {}
+  for o, a in opts:
+    if o == "-o":
+      outdir = os.path.abspath(a)
+    elif o == "-n":
+      settings["ids"] = int(a)
+    elif o == "-k":
+      settings["fragments"] = int(a)
+    elif o == "-s":
+      settings["samples"] = int(a)
+    elif o == "-q":
+      settings["standards"] = int(a)
+    elif o == "-d":
+      settings["density"] = float(a)
+    elif o == "-r":
+      settings["drift"] = float(a)
+    elif o == "-e":
+      settings["seed"] = int(a)
+  if not outdir:
+    print("missing options")
+    sys.exit(2)
+  print(synthDataset(outdir, **settings))
+
+if __name__ == "__main__":
+  main()
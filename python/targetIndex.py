@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+# Compiled target list index
+# A target list targets.csv is compiled once into targets.index/ next to it, or under
+# a fallback directory (GCCombo's feature directory) when the list's directory is read-only
+#   <column>.npy   id, subid, tmz, trt and the mz and rt bound columns, in target list order
+#   mzOrder.npy    target rows sorted by lower mz bound, with mzLower.npy and mzUpper.npy
+#                  the mz bounds in that order and mzWidth.npy the widest mz window
+#   rows.csv       the target list with its bound columns, for the feature tables
+#   index.json     hash of the target list content and parameters
+# An index is compiled in a temporary sibling directory and moved into place whole, so
+# runs that already mapped the arrays of a previous index keep reading intact files
+# GCCombo memory-maps the arrays, so its workers share one copy through the page cache
+# usage: targetIndex.py -t targets.csv [-r trtBound]
+
+# os operation libraries
+import sys
+import os
+import getopt
+import json
+import hashlib
+import shutil
+import tempfile
+
+# data libraries
+import numpy as np
+import pandas as pd
+
+# Target list layout and the bounds added to it
+targetColumns = ["id","name","tmz","trt","monoisotopic","cas","subid","formula","concentration"]
+#targetColumns = ["id","name","tmz","trt","monoisotopic","cas","subid","formula","concentration","note","realRt"]
+indexColumns = ["id","subid","tmz","trt","tmzupper","tmzlower","trtupper","trtlower"]
+mzTolerance = 0.000006 # relative mz window, 6 ppm
+trtBound = 0.3 # rt window in minutes
+
+# Index directory for a target list path, next to it or under indexdir
+def indexPath(targetlist, indexdir = None):
+  targetlist = os.path.abspath(targetlist)
+  name = os.path.splitext(os.path.basename(targetlist))[0] + ".index"
+  return os.path.join(os.path.abspath(indexdir) if indexdir else os.path.dirname(targetlist), name)
+
+# Hash of the target list content and the parameters the index depends on
+def indexHash(targetlist, trtBound):
+  digest = hashlib.blake2b(digest_size=20)
+  with open(targetlist, "rb") as targets:
+    for chunk in iter(lambda: targets.read(1 << 20), b""):
+      digest.update(chunk)
+  digest.update(repr((targetColumns, indexColumns, mzTolerance, trtBound)).encode())
+  return digest.hexdigest()
+
+# Read a target list and add its mz and rt search bounds
+def readTargets(targetlist, trtBound):
+  targets = pd.read_csv(targetlist, sep=',')
+  targets.columns = targetColumns
+  return addBounds(targets, trtBound)
+
+# Add the mz and rt search bounds to a target list
+def addBounds(targets, trtBound):
+  targets["tmzupper"] = targets.tmz + targets.tmz*mzTolerance
+  targets["tmzlower"] = targets.tmz - targets.tmz*mzTolerance
+  targets["trtupper"] = targets.trt + trtBound
+  targets["trtlower"] = targets.trt - trtBound
+  return targets
+
+# Compile a target list into its index, next to it or under indexdir
+# The index is written to a temporary sibling directory, the previous index is moved
+# aside and the new one moved into its place; when another run got there first with
+# a current index, that one is kept
+def compileTargets(targetlist, trtBound, indexdir = None):
+  index = indexPath(targetlist, indexdir)
+  os.makedirs(os.path.dirname(index), exist_ok=True)
+  staging = tempfile.mkdtemp(prefix=os.path.basename(index) + ".", dir=os.path.dirname(index))
+  try:
+    targets = readTargets(targetlist, trtBound)
+    for c in indexColumns:
+      np.save(staging + "/" + c + ".npy", targets[c].to_numpy())
+    mzOrder = np.argsort(targets.tmzlower.to_numpy(), kind="stable")
+    np.save(staging + "/mzOrder.npy", mzOrder)
+    np.save(staging + "/mzLower.npy", targets.tmzlower.to_numpy()[mzOrder])
+    np.save(staging + "/mzUpper.npy", targets.tmzupper.to_numpy()[mzOrder])
+    np.save(staging + "/mzWidth.npy", np.array(targets.tmzupper.sub(targets.tmzlower).max() if len(targets) > 0 else 0.0))
+    targets.to_csv(staging + "/rows.csv", index=False)
+    with open(staging + "/index.json", "w") as manifest:
+      json.dump({"hash": indexHash(targetlist, trtBound), "rows": len(targets)}, manifest)
+    if os.path.exists(index):
+      os.replace(index, staging + ".old")
+      shutil.rmtree(staging + ".old", ignore_errors=True)
+    try:
+      os.replace(staging, index)
+    except OSError:
+      if not indexCurrent(targetlist, trtBound, indexdir):
+        raise
+  finally:
+    shutil.rmtree(staging, ignore_errors=True)
+  return index
+
+# Check that the index of a target list matches its content and parameters
+def indexCurrent(targetlist, trtBound, indexdir = None):
+  manifest = indexPath(targetlist, indexdir) + "/index.json"
+  if not os.path.exists(manifest):
+    return False
+  with open(manifest) as manifest:
+    return json.load(manifest)["hash"] == indexHash(targetlist, trtBound)
+
+# Open the arrays of a compiled index, memory-mapped
+def openIndex(index):
+  arrays = {}
+  for name in indexColumns + ["mzOrder", "mzLower", "mzUpper", "mzWidth"]:
+    arrays[name] = np.load(index + "/" + name + ".npy", mmap_mode="r")
+  return arrays
+
+# Load a target list through its index, compiling it first when missing or stale
+# The index next to the list is used when current, then a current one under fallbackdir;
+# a list whose directory cannot be written is compiled under fallbackdir
+# Returns the index directory, its hash and the target rows
+def loadTargets(targetlist, trtBound, fallbackdir = None):
+  indexdir = None
+  if not indexCurrent(targetlist, trtBound):
+    if fallbackdir and indexCurrent(targetlist, trtBound, fallbackdir):
+      indexdir = fallbackdir
+    else:
+      print("compiling " + targetlist)
+      try:
+        compileTargets(targetlist, trtBound)
+      except OSError:
+        if not fallbackdir:
+          raise
+        print("cannot write next to " + targetlist + ", compiling under " + fallbackdir)
+        indexdir = fallbackdir
+        compileTargets(targetlist, trtBound, indexdir)
+  index = indexPath(targetlist, indexdir)
+  with open(index + "/index.json") as manifest:
+    hash = json.load(manifest)["hash"]
+  return index, hash, pd.read_csv(index + "/rows.csv", sep=",", float_precision="round_trip")
+
+def main():
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "t:r:")
+  except getopt.GetoptError as err:
+    print(err)
+    sys.exit(2)
+  targetlist = None
+  bound = trtBound
+  for o, a in opts:
+    if o == "-t":
+      targetlist = os.path.abspath(a)
+    elif o == "-r":
+      bound = float(a)
+  if not targetlist:
+    print("missing options")
+    sys.exit(2)
+  print(compileTargets(targetlist, bound))
+
+if __name__ == "__main__":
+  main()
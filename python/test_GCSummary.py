@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+# Regression cases of GCSummary
+# usage: python3 -m pytest python/test_GCSummary.py
+
+# os operation libraries
+import sys
+import os
+import io
+
+# data libraries
+import numpy as np
+import pandas as pd
+
+from GCSummary import idIndex, groupSlots, correlationFilter, parallelCorrelationFilter, qualityFlags, readInputs, summarize, main
+
+# Intensities of ids 1 to 3 over six samples, with ids 1 and 2 never detected
+def undetectedBlock():
+  summaries = pd.DataFrame({"id": [1, 1, 2, 3, 3, 3]})
+  intensities = pd.DataFrame(np.nan, index=summaries.index, columns=["s" + str(s) for s in range(0, 6)])
+  intensities.iloc[3:] = np.random.default_rng(3).lognormal(10, 1, (3, 6))
+  summaries["detectCnt"] = intensities.count(axis=1)
+  summaries["detectFrac"] = summaries["detectCnt"].div(len(intensities.columns))
+  return summaries, intensities
+
+# A block where no fragment is left for the correlation filter runs on several processes
+def test_parallelCorrelationFilterWithoutFragments():
+  summaries, intensities = undetectedBlock()
+  summaries = summaries.iloc[:3]
+  flags = qualityFlags(summaries, intensities.iloc[:3], idIndex(summaries["id"]), 0.0, 0.3, processors=2)
+  assert (flags["badFlag"] == 1).all()
+  assert (flags["corrMean"] == 0).all()
+
+# Parts of ids without any remaining fragment give the serial result
+def test_parallelCorrelationFilterUndetectedPart():
+  summaries, intensities = undetectedBlock()
+  index = idIndex(summaries["id"])
+  slots = groupSlots(np.where(summaries["detectCnt"] >= 3, index[0], -1), len(index[2]) - 1)
+  values = intensities.to_numpy()
+  serial = correlationFilter(values, slots, 0.3)
+  parallel = parallelCorrelationFilter(values, slots, 0.3, processors=2)
+  for s, p in zip(serial, parallel):
+    np.testing.assert_array_equal(s, p)
+  serialFlags = qualityFlags(summaries, intensities, index, 0.0, 0.3)
+  pd.testing.assert_frame_equal(qualityFlags(summaries, intensities, index, 0.0, 0.3, processors=2), serialFlags)
+
+# Feature tables of ids 1 to 3 over a BP1 standard and two subjects in replicate pairs,
+# written to featuresLoc with their batch; quants adds a quant table of the subject samples
+def featureTables(featuresLoc, quants):
+  rng = np.random.default_rng(3)
+  rows = pd.DataFrame({"id": [1, 1, 1, 2, 2, 3, 3, 3, 3], "subid": [1, 2, 3, 1, 2, 1, 2, 3, 4]})
+  rows["name"] = "c" + rows["id"].astype(str)
+  rows["tmz"] = rng.uniform(50, 500, len(rows)).round(4)
+  rows["trt"] = rows["id"] * 5.0
+  rows["monoisotopic"] = 100.0
+  rows["cas"] = "x"
+  rows["formula"] = "C"
+  rows["concentration"] = 1.0
+  batch = pd.DataFrame({"sample": ["S000", "S001", "S002", "S003", "S004"], "type": ["BP1", "subject", "subject", "subject", "subject"],
+    "dilu": [1.0, np.nan, np.nan, np.nan, np.nan], "batch": 1, "id": ["std0", "sub0", "sub0", "sub1", "sub1"]})
+  samples = batch["sample"].tolist()
+  tables = {
+    "i": rng.lognormal(10, 1, (len(rows), len(samples))).round(1),
+    "mz": rows["tmz"].to_numpy()[:, None] + rng.normal(0, 0.0001, (len(rows), len(samples))),
+    "rt": rows["trt"].to_numpy()[:, None] + rng.normal(0, 0.01, (len(rows), len(samples)))
+    }
+  for name, values in tables.items():
+    pd.concat([rows, pd.DataFrame(values, columns=samples)], axis=1).to_csv(featuresLoc + "feature.sample." + name + ".csv")
+  if quants:
+    quant = rows.assign(dsamp="S000", dconc=1.0, beta=0.5, rsquared=1.0)
+    pd.concat([quant, pd.DataFrame(tables["i"][:, 1:] * 0.5, columns=samples[1:])], axis=1).to_csv(featuresLoc + "feature.sample.quant.csv")
+  return batch
+
+# Non-quant variants from the command line neither need the quant table nor take its
+# samples, and write the summaries of the single-summary path
+def test_variantsWithoutQuants(tmp_path, monkeypatch):
+  for quants in [False, True]:
+    featuresLoc = str(tmp_path) + ("/quants/" if quants else "/plain/")
+    os.makedirs(featuresLoc)
+    batch = featureTables(featuresLoc, quants)
+    batch.to_csv(featuresLoc + "batch.csv", index=False)
+    monkeypatch.setattr(sys, "argv", ["GCSummary.py", "-f", featuresLoc, "-b", featuresLoc + "batch.csv", "-s", "BP1", "-l", "subject,BP1", "--variants=subject.summary,sample.summary"])
+    main()
+    inputs = readInputs(featuresLoc)
+    for variant, repToggle in [("subject.summary", True), ("sample.summary", False)]:
+      single = summarize(inputs, batch, ["subject", "BP1"], "BP1", repToggle)
+      pd.testing.assert_frame_equal(pd.read_csv(featuresLoc + "feature." + variant + ".csv", index_col=0), pd.read_csv(io.StringIO(single.to_csv()), index_col=0))